@@ -0,0 +1,413 @@
+"""Time the hot spots of the pipeline against synthetic data
+
+`generate` builds a synthetic library (a raw/ tree plus a data.db full of
+movies, thumbnails, ratings and used cuts) and `run` times the hot
+functions of each script on it, comparing against saved baselines.
+The other commands are focused benchmarks of single changes.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import pathlib
+
+import constants as C
+import intervals
+import make_thumbs
+import multi_movie_cuts
+import review_screens
+import util
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    db_parser = subparsers.add_parser(
+        'db', help="time the common queries before and after the schema migrations")
+    db_parser.add_argument('--movies', type=int, default=500)
+    db_parser.add_argument('--thumbs', type=int, default=250, help="thumbnails per movie")
+    db_parser.add_argument('--repeat', type=int, default=200)
+    review_parser = subparsers.add_parser(
+        'review', help="time review_screens candidate selection")
+    review_parser.add_argument('--movies', type=int, default=10000)
+    review_parser.add_argument('--thumbs', type=int, default=500, help="thumbnails per movie")
+    review_parser.add_argument('--batch-size', type=int, default=100)
+    cuts_parser = subparsers.add_parser(
+        'cuts', help="time IntervalIndex against has_overlap")
+    cuts_parser.add_argument('--movies', type=int, default=1000)
+    cuts_parser.add_argument('--cuts', type=int, default=50, help="used cuts per movie")
+    cuts_parser.add_argument('--queries', type=int, default=100000)
+    good_parser = subparsers.add_parser(
+        'good-thumbs', help="time the get_all_good_thumbs methods")
+    good_parser.add_argument('--movies', type=int, default=4000)
+    good_parser.add_argument('--thumbs', type=int, default=500, help="thumbnails per movie")
+    generate_parser = subparsers.add_parser(
+        'generate', help="build a synthetic library in a directory")
+    add_library_arguments(generate_parser)
+    generate_parser.add_argument('dir', type=pathlib.Path)
+    run_parser = subparsers.add_parser(
+        'run', help="time the hot functions of every script and compare against the baselines")
+    add_library_arguments(run_parser)
+    run_parser.add_argument(
+        '--dir', type=pathlib.Path,
+        help="a library made by 'generate' (default: generate one in a temporary directory)")
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument(
+        '--baselines', type=pathlib.Path, default=C.DATADIR.joinpath('benchmarks.json'))
+    run_parser.add_argument(
+        '--save', action='store_true', help="store these timings as the new baselines")
+    run_parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help="report a regression when a timing is this much slower than its baseline")
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate_library(args.dir, args.movies, args.thumbs, args.cuts, args.real)
+    elif args.command == 'run':
+        if args.dir:
+            key, results = bench_library(args.dir, args.repeat)
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                generate_library(pathlib.Path(tmp), args.movies, args.thumbs, args.cuts, args.real)
+                key, results = bench_library(pathlib.Path(tmp), args.repeat)
+        regressed = compare_baselines(args.baselines, key, results, args.tolerance)
+        if args.save:
+            save_baselines(args.baselines, key, results)
+        return 1 if regressed else 0
+    elif args.command == 'db':
+        bench_db(args.movies, args.thumbs, args.repeat)
+    elif args.command == 'review':
+        bench_review(args.movies, args.thumbs, args.batch_size)
+    elif args.command == 'cuts':
+        bench_cuts(args.movies, args.cuts, args.queries)
+    elif args.command == 'good-thumbs':
+        bench_good_thumbs(args.movies, args.thumbs)
+
+
+def timeit(fn, repeat):
+    """Return the mean seconds per call of fn() over `repeat` calls."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def fill_db(db, movies, thumbs, seed=0, cuts=0):
+    rand = random.Random(seed)
+    metadata = json.dumps({
+        'video': {'duration': 15.0 * (thumbs + 2), 'width': 3840, 'height': 1920},
+        'format': {'fov': '180', 'orientation': 'sbs', 'perspective': 'normal'},
+    })
+    with db:
+        db.executemany(
+            'INSERT INTO movie (id, folder, filename, metadata) VALUES (?, ?, ?, ?)',
+            [(i, 'actress.{}-movie.{}'.format(i, i), 'movie{}.mp4'.format(i), metadata)
+             for i in range(1, movies + 1)])
+        thumbnails = (
+            (movie_id, 'thumb{:04d}.jpg'.format(i), rand.choice([None, None, 0, 1]),
+             i * C.SCREENSHOT_FREQUENCY + C.SCREENSHOT_START)
+            for movie_id in range(1, movies + 1) for i in range(thumbs))
+        # bench_db starts from a version 1 database, which has no ts yet
+        if 'ts' in [row[1] for row in db.execute('PRAGMA table_info(thumbnail)')]:
+            db.executemany(
+                'INSERT INTO thumbnail (movie_id, filename, rating, ts) VALUES (?, ?, ?, ?)',
+                thumbnails)
+        else:
+            db.executemany(
+                'INSERT INTO thumbnail (movie_id, filename, rating) VALUES (?, ?, ?)',
+                (t[:3] for t in thumbnails))
+        duration = 15.0 * (thumbs + 2)
+        db.executemany(
+            'INSERT INTO used_cuts (collage, movie_id, start, end) VALUES (?, ?, ?, ?)',
+            (('collage/synthetic.mp4', movie_id, *random_slice(rand, duration))
+             for movie_id in range(1, movies + 1) for _ in range(cuts)))
+
+
+DB_QUERIES = [
+    ('catalog.get_folder_movie',
+     'SELECT id FROM movie WHERE folder = ?',
+     lambda r, m, t: ('actress.{}-movie.{}'.format(m, m),)),
+    ('save_metadata.save_folder',
+     'SELECT id FROM movie WHERE filename = ?',
+     lambda r, m, t: ('movie{}.mp4'.format(m),)),
+    ('ratings.write_ratings',
+     'SELECT id, rating FROM thumbnail WHERE movie_id = ? AND filename = ?',
+     lambda r, m, t: (m, 'thumb{:04d}.jpg'.format(t))),
+]
+
+
+def bench_db(movies, thumbs, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = util.connect(pathlib.Path(tmp).joinpath('data.db'), version=1)
+        fill_db(db, movies, thumbs)
+        print('{} movies, {} thumbnails'.format(movies, movies * thumbs))
+        rand = random.Random(1)
+
+        def run_queries():
+            results = {}
+            for name, sql, params in DB_QUERIES:
+                def query():
+                    args = params(rand, rand.randint(1, movies), rand.randrange(thumbs))
+                    db.execute(sql, args).fetchall()
+                results[name] = timeit(query, repeat)
+            def all_thumbs():
+                db.execute(
+                    'SELECT m.id, folder, t.filename, rating FROM thumbnail t '
+                    'INNER JOIN movie m ON t.movie_id = m.id').fetchall()
+            results['multi_movie_cuts.get_all_thumbs'] = timeit(all_thumbs, 3)
+            def all_screens():
+                db.execute(
+                    'SELECT movie_id, filename, rating FROM thumbnail '
+                    'ORDER BY movie_id, filename').fetchall()
+            results['review_screens.get_all_screens'] = timeit(all_screens, 3)
+            return results
+
+        before = run_queries()
+        util.migrate(db)
+        after = run_queries()
+        print('{:45s} {:>12s} {:>12s}'.format('query', 'before (ms)', 'after (ms)'))
+        for name in before:
+            print('{:45s} {:12.3f} {:12.3f}'.format(
+                name, before[name] * 1000, after[name] * 1000))
+        db.close()
+
+
+def synthetic_screens(movies, thumbs, seed=0):
+    """Return {folder: [(thumbnail, rating), ...]} where about a third of
+    the movies have a stretch of rated screens."""
+    rand = random.Random(seed)
+    names = ['thumb{:04d}.jpg'.format(i) for i in range(thumbs)]
+    unrated = [(name, None) for name in names]
+    all_screens = {}
+    for m in range(movies):
+        screens = list(unrated)
+        if rand.random() < 0.3:
+            start = rand.randrange(thumbs)
+            for i in range(start, min(thumbs, start + rand.randint(1, 40))):
+                screens[i] = (names[i], rand.choice([0, 1, 1]))
+        all_screens['actress.{}-movie.{}'.format(m, m)] = screens
+    return all_screens
+
+
+def bench_review(movies, thumbs, batch_size):
+    all_screens = synthetic_screens(movies, thumbs)
+    print('{} movies, {} screens'.format(movies, movies * thumbs))
+    start = time.perf_counter()
+    indexed = {k: review_screens.MovieScreens(v) for k, v in all_screens.items()}
+    print('MovieScreens:      {:8.1f} ms'.format((time.perf_counter() - start) * 1000))
+    elapsed = timeit(lambda: review_screens.pick_candidates(indexed, batch_size), 5)
+    print('pick_candidates:   {:8.1f} ms'.format(elapsed * 1000))
+
+
+def random_slice(rand, duration, max_length=45):
+    start = rand.uniform(0, duration)
+    return (start, min(duration, start + rand.uniform(0, max_length)))
+
+
+def bench_cuts(movies, cuts, queries, seed=0):
+    rand = random.Random(seed)
+    duration = 3600
+    rows = [(m, *random_slice(rand, duration)) for m in range(movies) for _ in range(cuts)]
+    candidates = [(rand.randrange(movies), random_slice(rand, duration)) for _ in range(queries)]
+    print('{} used cuts, {} overlap checks'.format(len(rows), queries))
+
+    start = time.perf_counter()
+    by_movie = collections.defaultdict(list)
+    for movie_id, a, b in rows:
+        by_movie[movie_id].append((a, b))
+    for movie_id, candidate in candidates:
+        multi_movie_cuts.has_overlap(candidate, by_movie[movie_id])
+    print('has_overlap:    {:8.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+    start = time.perf_counter()
+    index = intervals.index_by_movie(sorted(rows))
+    for movie_id, candidate in candidates:
+        index[movie_id].overlaps(candidate)
+    print('IntervalIndex:  {:8.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+
+def use_db(datadir):
+    """Point util.get_db (and everything else reading C.DATADIR) at a
+    database in `datadir`."""
+    if util._db:
+        util._db.close()
+    util._db = None
+    C.DATADIR = pathlib.Path(datadir)
+    return util.get_db()
+
+
+def bench_good_thumbs(movies, thumbs):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = use_db(tmp)
+        fill_db(db, movies, thumbs)
+        print('{} movies, {} thumbnails'.format(movies, movies * thumbs))
+        results = {}
+        for method in ['python', 'sql', 'numpy']:
+            if method == 'numpy' and multi_movie_cuts.np is None:
+                print('numpy is not installed, skipping')
+                continue
+            start = time.perf_counter()
+            results[method] = sorted(multi_movie_cuts.get_all_good_thumbs(method=method))
+            print('{:8s} {:8.1f} ms, {} good thumbnails'.format(
+                method, (time.perf_counter() - start) * 1000, len(results[method])))
+        use_db(tmp).close()
+        util._db = None
+
+
+def add_library_arguments(parser):
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--thumbs', type=int, default=400, help="thumbnails per movie")
+    parser.add_argument('--cuts', type=int, default=5, help="used cuts per movie")
+    parser.add_argument(
+        '--real', action='store_true',
+        help="encode small ffmpeg testsrc side-by-side movies instead of using stub "
+             "ffmpeg/ffprobe commands")
+
+
+# Stand-ins for ffmpeg and ffprobe so the pure python paths can be
+# exercised without real movies. A stub movie file holds the JSON that
+# ffprobe should print for it.
+STUB_FFPROBE = """#!/usr/bin/env python3
+import sys
+with open(sys.argv[-1]) as fin:
+    print(fin.read())
+"""
+STUB_FFMPEG = """#!/usr/bin/env python3
+import sys
+args = sys.argv[1:]
+count = int(args[args.index('-frames:v') + 1]) if '-frames:v' in args else 1
+first = int(args[args.index('-start_number') + 1]) if '-start_number' in args else 0
+for i in range(first, first + count):
+    with open(args[-1] % i if '%' in args[-1] else args[-1], 'wb') as fout:
+        fout.write(b'\\xff\\xd8stub\\xff\\xd9')
+"""
+
+
+def generate_library(base, movies, thumbs, cuts, real=False):
+    """Make base/raw, base/data/data.db and (unless `real`) stub
+    ffmpeg/ffprobe commands in base/bin."""
+    raw = base.joinpath('raw')
+    raw.mkdir(parents=True, exist_ok=True)
+    bin_dir = base.joinpath('bin')
+    if not real:
+        bin_dir.mkdir(exist_ok=True)
+        for name, script in [('ffprobe', STUB_FFPROBE), ('ffmpeg', STUB_FFMPEG)]:
+            path = bin_dir.joinpath(name)
+            path.write_text(script)
+            path.chmod(0o755)
+    duration = 15.0 * (thumbs + 2)
+    width, height = (640, 320) if real else (3840, 1920)
+    for i in range(1, movies + 1):
+        folder = raw.joinpath('actress.{}-movie.{}'.format(i, i))
+        folder.mkdir(exist_ok=True)
+        with folder.joinpath('metadata.yaml').open('w') as fout:
+            fout.write('format:\n  fov: \'180\'\n  orientation: sbs\n  perspective: normal\n')
+        # the thumbnails are only in the db, but review skips movies
+        # without a finished screens folder
+        screens = folder.joinpath('screens')
+        screens.mkdir(exist_ok=True)
+        make_thumbs.write_manifest(screens)
+        movie = folder.joinpath('movie{}.mp4'.format(i))
+        if real:
+            cmd = [
+                'ffmpeg', '-y', '-v', 'error',
+                '-f', 'lavfi', '-i', 'testsrc=size={}x{}:rate=30:duration={}'.format(
+                    width, height, duration),
+                '-f', 'lavfi', '-i', 'sine=duration={}'.format(duration),
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', str(movie)]
+            util.run(cmd, check=True)
+        else:
+            movie.write_text(json.dumps({'streams': [
+                {'codec_type': 'video', 'codec_name': 'h264', 'duration': str(duration),
+                 'width': width, 'height': height, 'pix_fmt': 'yuv420p'},
+                {'codec_type': 'audio', 'codec_name': 'aac', 'duration': str(duration)},
+            ], 'format': {'duration': str(duration)}}))
+    base.joinpath('data').mkdir(exist_ok=True)
+    db = util.connect(base.joinpath('data', 'data.db'))
+    fill_db(db, movies, thumbs, cuts=cuts)
+    db.close()
+    print('made {} movies with {} thumbnails each in {}'.format(movies, thumbs, base))
+
+
+def bench_library(base, repeat):
+    """Time the hot functions of each script on the library in `base`.
+
+    Returns the baseline key for the library's size and {function: seconds}.
+    """
+    import save_metadata
+    C.RAWDIR = base.joinpath('raw')
+    db = use_db(base.joinpath('data'))
+    key = '{} movies, {} thumbnails'.format(
+        db.execute('SELECT count(*) FROM movie').fetchone()[0],
+        db.execute('SELECT count(*) FROM thumbnail').fetchone()[0])
+    if base.joinpath('bin').exists():
+        os.environ['PATH'] = str(base.joinpath('bin')) + os.pathsep + os.environ['PATH']
+
+    options = list(multi_movie_cuts.get_all_good_thumbs())
+    all_screens = {k: review_screens.MovieScreens(v)
+                   for k, v in review_screens.get_all_screens()}
+    if not all_screens:
+        raise Exception('no movie in {} has screens to review'.format(C.RAWDIR))
+    movie_screens = list(all_screens.values())
+
+    def plan():
+        excludes = multi_movie_cuts.get_used_cuts()
+        durations = {row['id']: row['duration']
+                     for row in util.query_movies(**review_screens.BASIC_FORMAT)}
+        list(multi_movie_cuts.get_timestamps(
+            multi_movie_cuts.lazy_shuffle(list(options)), durations, excludes, 8 * 60))
+
+    benchmarks = [
+        ('save_metadata.get_movie_files', lambda: list(save_metadata.get_movie_files()), 1),
+        ('review_screens.get_all_screens',
+         lambda: list(review_screens.get_all_screens()), repeat),
+        ('review_screens.pick_screen',
+         lambda: [review_screens.pick_screen(m) for m in movie_screens[:1000] if m.unrated],
+         repeat),
+        ('review_screens.pick_candidates',
+         lambda: review_screens.pick_candidates(all_screens), repeat),
+        ('multi_movie_cuts.get_used_cuts', multi_movie_cuts.get_used_cuts, repeat),
+        ('multi_movie_cuts.get_all_good_thumbs',
+         lambda: list(multi_movie_cuts.get_all_good_thumbs()), repeat),
+        ('multi_movie_cuts.get_timestamps', plan, repeat),
+    ]
+    results = {}
+    print('{:40s} {:>10s}'.format('function', 'ms'))
+    for name, fn, n in benchmarks:
+        results[name] = timeit(fn, n)
+        print('{:40s} {:10.2f}'.format(name, results[name] * 1000))
+    return key, results
+
+
+def compare_baselines(path, key, results, tolerance):
+    if not path.exists():
+        return False
+    with path.open() as fin:
+        baselines = json.load(fin).get(key, {})
+    regressed = False
+    for name, seconds in results.items():
+        baseline = baselines.get(name)
+        if baseline and seconds > baseline * (1 + tolerance):
+            print('REGRESSION {}: {:.2f} ms, baseline {:.2f} ms'.format(
+                name, seconds * 1000, baseline * 1000))
+            regressed = True
+    return regressed
+
+
+def save_baselines(path, key, results):
+    baselines = {}
+    if path.exists():
+        with path.open() as fin:
+            baselines = json.load(fin)
+    baselines[key] = results
+    with path.open('w') as fout:
+        json.dump(baselines, fout, indent=1, sort_keys=True)
+    print('saved baselines for {} to {}'.format(key, path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""The movies in the database, loaded once per process.
+
+get_catalog() reads every movie's id, folder and file in one query and
+keeps them as Movie records indexed by id and folder, so finding the
+movie of a thumbnail or a file in RAWDIR is a dict lookup rather than
+a walk up the path and a query per file. Metadata is kept as the JSON
+text and only decoded for the movies that are asked for it.
+
+Movies saved after the catalog was loaded are picked up when they are
+first looked up (save_metadata also adds them as it saves them).
+"""
+import json
+import threading
+
+import constants as C
+import util
+
+
+class Movie:
+    __slots__ = ('id', 'folder', 'filename', '_metadata')
+
+    def __init__(self, id, folder, filename, metadata):
+        self.id = id
+        self.folder = folder
+        self.filename = filename
+        # the JSON text until someone needs the metadata
+        self._metadata = metadata
+
+    @property
+    def metadata(self):
+        if isinstance(self._metadata, str):
+            self._metadata = json.loads(self._metadata)
+        return self._metadata
+
+    @property
+    def base_dir(self):
+        return C.RAWDIR.joinpath(self.folder)
+
+    @property
+    def path(self):
+        return C.RAWDIR.joinpath(self.folder, self.filename)
+
+    def __repr__(self):
+        return 'Movie({}, {!r})'.format(self.id, self.folder)
+
+
+# metadata is selected as an expression so the JSON converter leaves it as text
+MOVIE_SQL = 'SELECT id, folder, filename, metadata || \'\' AS metadata FROM movie'
+
+
+class Catalog:
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_folder = {}
+        # str(thumbnail or movie file path) -> Movie
+        self.by_path = {}
+        # str(directory) -> the folder name in RAWDIR it is in
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(sorted(self.by_id.values(), key=lambda movie: movie.id))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def load(self, db=None):
+        db = db or util.get_db()
+        rows = db.execute(MOVIE_SQL).fetchall()
+        with self.lock:
+            self.by_id.clear()
+            self.by_folder.clear()
+            self.by_path.clear()
+            for row in rows:
+                self._add(Movie(*row))
+        return self
+
+    def add(self, movie_id, folder, filename, metadata=None):
+        """Record a movie that was just saved; metadata may be a dict."""
+        with self.lock:
+            old = self.by_id.get(movie_id)
+            if old is not None and self.by_folder.get(old.folder) is old:
+                del self.by_folder[old.folder]
+                self.by_path.clear()
+            return self._add(Movie(movie_id, folder, str(filename), metadata))
+
+    def _add(self, movie):
+        self.by_id[movie.id] = movie
+        self.by_folder[movie.folder] = movie
+        return movie
+
+    def get(self, movie_id, db=None):
+        movie = self.by_id.get(movie_id)
+        if movie is None:
+            movie = self._fetch('id', movie_id, db)
+        return movie
+
+    def get_folder_movie(self, folder, db=None):
+        """The movie in RAWDIR/<folder>, or None if it hasn't been saved."""
+        movie = self.by_folder.get(folder)
+        if movie is None:
+            movie = self._fetch('folder', folder, db)
+        return movie
+
+    def _fetch(self, column, value, db):
+        # a movie saved (by another process) since the catalog was loaded
+        db = db or util.get_db()
+        row = db.execute(MOVIE_SQL + ' WHERE {} = ?'.format(column), (value,)).fetchone()
+        if row is None:
+            return None
+        with self.lock:
+            return self._add(Movie(*row))
+
+    def find(self, path, db=None):
+        """The movie that a file somewhere in its folder belongs to
+        (a thumbnail, the movie itself, ...), or None."""
+        key = str(path)
+        movie = self.by_path.get(key)
+        if movie is None:
+            movie = self.get_folder_movie(self.get_folder(path).name, db)
+            if movie is not None:
+                self.by_path[key] = movie
+        return movie
+
+    def get_folder(self, path):
+        """The folder in RAWDIR that `path` is in."""
+        parent = str(path.parent)
+        name = self.folders.get(parent)
+        if name is None:
+            raw = C.RAWDIR.parts
+            parts = path.parts
+            if len(parts) < len(raw) + 2 or parts[:len(raw)] != raw:
+                raise Exception('No valid folder found for {}'.format(path))
+            name = self.folders[parent] = parts[len(raw)]
+        return C.RAWDIR.joinpath(name)
+
+
+_catalog = None
+def get_catalog(db=None) -> Catalog:
+    global _catalog
+    if _catalog is None:
+        _catalog = Catalog().load(db)
+    return _catalog
+
+
+def get_folder(path):
+    return get_catalog().get_folder(path)
+
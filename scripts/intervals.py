@@ -0,0 +1,50 @@
+"""Per-movie index of used cuts for fast overlap checks"""
+import bisect
+import collections
+
+
+class IntervalIndex:
+    """Closed intervals sorted by start, with a running maximum of the ends.
+
+    Any interval starting at or before the end of a candidate overlaps
+    it as long as it ends at or after the candidate's start, so an
+    overlap query is one bisect plus one lookup in the running maximum.
+    """
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.max_ends = []
+        for start, end in sorted(intervals):
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        max_end = max(end, self.max_ends[i - 1]) if i else end
+        self.max_ends.insert(i, max_end)
+        for j in range(i + 1, len(self.max_ends)):
+            if self.max_ends[j] >= max_end:
+                break
+            self.max_ends[j] = max_end
+
+    def overlaps(self, candidate):
+        """Same answer as multi_movie_cuts.has_overlap(candidate, intervals)."""
+        start, end = candidate
+        i = bisect.bisect_right(self.starts, end)
+        return i > 0 and self.max_ends[i - 1] >= start
+
+
+def index_by_movie(rows):
+    """Build {movie_id: IntervalIndex} from (movie_id, start, end) rows.
+
+    Movies without any intervals get an empty index on lookup.
+    """
+    results = collections.defaultdict(IntervalIndex)
+    for movie_id, start, end in rows:
+        results[movie_id].add(start, end)
+    return results
@@ -0,0 +1,188 @@
+"""Index the keyframes and scene changes of each movie.
+
+The keyframe times come from ffprobe's packet list (only the demuxer
+runs, nothing is decoded); scene changes need a decode, done at a low
+resolution, and are optional. Both are stored in the movie_index table
+as packed arrays of doubles, and are redone when the movie file's size
+or mtime changes.
+
+multi_movie_cuts.py --snap keyframe|scene moves cut boundaries onto
+these times, so the cuts start where a seek lands anyway and can be
+stream copied.
+"""
+import argparse
+import array
+import bisect
+import collections
+import re
+import sys
+
+import catalog
+import make_thumbs
+import util
+
+# ffmpeg's scene score is 0..1; cuts between shots are well above this
+SCENE_THRESHOLD = 0.3
+# frames are scored at this width, the scene score doesn't need more
+SCENE_WIDTH = 320
+
+Index = collections.namedtuple('Index', 'keyframes scenes scene_scores')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--scenes', action='store_true', help="also find the scene changes (decodes every movie)")
+    parser.add_argument(
+        '--threshold', type=float, default=SCENE_THRESHOLD,
+        help="scene score above which a frame counts as a scene change")
+    parser.add_argument(
+        '--refresh', action='store_true', help="index movies even if they already are")
+    args = parser.parse_args()
+
+    with util.timed('index movies', items=0) as counts:
+        for movie in catalog.get_catalog():
+            if index_movie(movie, args.scenes, args.threshold, args.refresh):
+                counts['items'] += 1
+
+
+def index_movie(movie, scenes=False, threshold=SCENE_THRESHOLD, refresh=False):
+    """Index one movie unless its index is current; returns whether it
+    was (re)indexed."""
+    path = movie.path
+    stat = path.stat()
+    db = util.get_db()
+    row = db.execute(
+        'SELECT size, mtime_ns, keyframes, scenes, scene_threshold FROM movie_index '
+        'WHERE movie_id = ?', (movie.id,)).fetchone()
+    current = row is not None and (row['size'], row['mtime_ns']) == (
+        stat.st_size, stat.st_mtime_ns)
+    if current and not refresh:
+        if not scenes or (row['scenes'] is not None and row['scene_threshold'] == threshold):
+            return False
+    print(path)
+    if current and not refresh:
+        # only the scenes are missing
+        keyframes = row['keyframes']
+    else:
+        keyframes = pack(get_keyframes(path))
+    if scenes:
+        scene_times, scene_scores = (pack(a) for a in get_scenes(path, threshold))
+    else:
+        # the old index is out of date, its scenes included
+        scene_times = scene_scores = threshold = None
+    with util.transaction(db):
+        db.execute(
+            'INSERT OR REPLACE INTO movie_index '
+            '(movie_id, size, mtime_ns, keyframes, scenes, scene_scores, scene_threshold) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (movie.id, stat.st_size, stat.st_mtime_ns, keyframes, scene_times, scene_scores,
+             threshold))
+    return True
+
+
+def pack(values):
+    return array.array('d', values).tobytes()
+
+
+def unpack(blob):
+    values = array.array('d')
+    if blob is not None:
+        values.frombytes(blob)
+    return values
+
+
+def keyframes_cmd(filename):
+    return [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0',
+        str(filename)]
+
+
+def get_keyframes(filename):
+    """The sorted times, in seconds, of the keyframes in the video stream.
+
+    Like thumbnail.ts and -ss, they count from the file's start_time,
+    which is earlier than the video stream's when the audio starts first.
+    """
+    _, start_time = make_thumbs.get_clock(filename)
+    p = util.run(keyframes_cmd(filename), check=True, stage='keyframes', capture=True)
+    return parse_keyframes(p.stdout.decode('utf-8'), float(start_time))
+
+
+def parse_keyframes(output, start_time=0.0):
+    # ffprobe's packet times are on the file's own clock, which
+    # doesn't start at 0 in MPEG-TS and many camera files
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if flags.startswith('K') and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time) - start_time)
+    # packets are in decode order, which isn't presentation order with B frames
+    keyframes.sort()
+    return keyframes
+
+
+def scenes_cmd(filename, threshold=SCENE_THRESHOLD):
+    vf = "scale={}:-2,select='gt(scene,{})',metadata=print:key=lavfi.scene_score".format(
+        SCENE_WIDTH, threshold)
+    return [
+        'ffmpeg', '-hide_banner', '-nostats', '-i', str(filename), '-map', '0:v:0', '-an',
+        '-vf', vf, '-f', 'null', '-']
+
+
+def get_scenes(filename, threshold=SCENE_THRESHOLD):
+    """Return (times, scores) of the frames that start a new scene."""
+    p = util.run(scenes_cmd(filename, threshold), check=True, stage='scenes',
+                 capture_stderr=True)
+    return parse_scenes(p.stderr.decode('utf-8', 'replace'))
+
+
+def parse_scenes(log):
+    # metadata=print logs "frame:N pts:P pts_time:T" and then the score
+    times = []
+    scores = []
+    pts_time = None
+    for line in log.splitlines():
+        m = re.search(r'\bpts_time:(\S+)', line)
+        if m:
+            pts_time = float(m.group(1))
+            continue
+        m = re.search(r'lavfi\.scene_score=([0-9.]+)', line)
+        if m and pts_time is not None:
+            times.append(pts_time)
+            scores.append(float(m.group(1)))
+            pts_time = None
+    return times, scores
+
+
+def get_indexes(movie_ids=None):
+    """Return movie_id -> Index of the indexed movies (all, or those in
+    `movie_ids`), with the times as array('d')."""
+    movie_ids = None if movie_ids is None else set(movie_ids)
+    indexes = {}
+    cur = util.get_db().execute(
+        'SELECT movie_id, keyframes, scenes, scene_scores FROM movie_index')
+    for row in cur:
+        if movie_ids is not None and row['movie_id'] not in movie_ids:
+            continue
+        indexes[row['movie_id']] = Index(
+            unpack(row['keyframes']), unpack(row['scenes']), unpack(row['scene_scores']))
+    return indexes
+
+
+def snap(ts, points, tolerance):
+    """The time in sorted `points` closest to `ts`, if it is within
+    `tolerance` seconds, otherwise `ts` itself."""
+    i = bisect.bisect_left(points, ts)
+    best = ts
+    best_distance = tolerance
+    for j in (i - 1, i):
+        if 0 <= j < len(points) and abs(points[j] - ts) <= best_distance:
+            best = points[j]
+            best_distance = abs(points[j] - ts)
+    return best
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,46 +1,499 @@
 """Extract thumbnails from movie"""
+import argparse
+import collections
+import concurrent.futures
+import fractions
+import json
+import os
+import re
 import shlex
 import shutil
 import subprocess
 import sys
 
 import constants as C
+import packs
 import util
 
 
 def main():
-    for movie_id, filename, metadata in util.get_file_data():
-        dirname = util.get_folder(filename)
-        screens = dirname.joinpath('screens')
-        if screens.exists():
-            continue
-        screens_tmp = dirname.joinpath('screens-tmp')
-        duration = metadata['video']['duration']
-        orientation = metadata['format']['orientation']
-        make_screens(movie_id, filename, duration, orientation, screens_tmp)
-        shutil.move(str(screens_tmp), str(screens))
-
-
-def make_screens(movie_id, filename, duration, orientation, screens_tmp):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--engine', choices=['single-pass', 'per-frame', 'keyframe'], default='single-pass',
+        help="single-pass decodes each movie once; per-frame runs one ffmpeg per thumbnail; "
+             "keyframe is per-frame but only decodes the nearest keyframe, at reduced "
+             "resolution where the codec allows it")
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help="number of ffmpeg processes to run at the same time")
+    parser.add_argument(
+        '--frames-per-job', type=int, default=40,
+        help="in single-pass mode, split a movie into ffmpeg jobs of this many thumbnails")
+    parser.add_argument(
+        '--preview-width', type=int,
+        help="scale thumbnails down to this width (default: {} in keyframe mode, "
+             "full size otherwise)".format(KEYFRAME_PREVIEW_WIDTH))
+    parser.add_argument(
+        '--pack', action='store_true',
+        help="store each movie's thumbnails in one screens.pack file (see packs.py)")
+    args = parser.parse_args()
+    preview_width = args.preview_width
+    if preview_width is None and args.engine == 'keyframe':
+        preview_width = KEYFRAME_PREVIEW_WIDTH
+
+    jobs = []
+    for row in util.query_movies():
+        job = plan_movie(row, args.engine, args.frames_per_job, preview_width, args.pack)
+        if job:
+            jobs.append(job)
+    run_jobs(jobs, args.workers)
+
+
+def plan_movie(row, engine='single-pass', frames_per_job=40, preview_width=None, pack=False):
+    """Return the ScreenJob for a movie row, or None if its screens are done."""
+    dirname = C.RAWDIR.joinpath(row['folder'])
+    screens = dirname.joinpath('screens')
+    screens_tmp = dirname.joinpath('screens-tmp')
+    if screens.exists():
+        if is_current(read_manifest(screens)):
+            return None
+        # the screenshot constants changed; top up the existing
+        # screens in screens-tmp and swap them back in at the end
+        print('{} was made with different screenshot settings'.format(screens))
+        packs.unpack_screens(row['id'], screens)
+        shutil.move(str(screens), str(screens_tmp))
+    job = make_screens(
+        row['id'], util.movie_path(row), row['duration'], row['orientation'], screens_tmp,
+        engine, frames_per_job, preview_width)
+    return job._replace(pack=pack)
+
+
+# cmds is a list of (ffmpeg command, number of thumbnails it writes);
+# timestamps maps thumbnail name -> [ts, pts] of the frame it shows;
+# clock is the (time_base of the video stream, start_time of the file)
+ScreenJob = collections.namedtuple(
+    'ScreenJob', 'movie_id count screens_tmp cmds timestamps clock pack', defaults=(False,))
+
+# records the SCREENSHOT_START/SCREENSHOT_FREQUENCY a screens folder was made with
+MANIFEST = 'screens.json'
+
+# the [ts, pts] of every thumbnail ffmpeg has written so far
+TIMESTAMPS = 'timestamps.json'
+
+FFMPEG = ['ffmpeg', '-hide_banner', '-nostats']
+
+KEYFRAME_PREVIEW_WIDTH = 960
+
+# decoders that implement -lowres (decoding at 1/2, 1/4, ... of the size)
+LOWRES_CODECS = {
+    'dvvideo', 'h261', 'h263', 'jpeg2000', 'mjpeg', 'mpeg1video', 'mpeg2video', 'mpeg4',
+    'msmpeg4v1', 'msmpeg4v2', 'msmpeg4v3', 'wmv1', 'wmv2'}
+
+
+def make_screens(movie_id, filename, duration, orientation, screens_tmp,
+                 engine='single-pass', frames_per_job=40, preview_width=None):
+    """Plan the ffmpeg commands for the thumbnails that screens_tmp is missing.
+
+    screens_tmp may be left over from a run that died part way
+    through, or hold screens made with older screenshot constants;
+    valid thumbnails in it are kept and only the gaps get extracted.
+    """
+    screens_tmp.mkdir(exist_ok=True)
+    manifest = read_manifest(screens_tmp)
+    if manifest and not is_current(manifest):
+        remap_screens(movie_id, screens_tmp, manifest)
+    write_manifest(screens_tmp)
+    timestamps = get_screen_timestamps(duration)
+    count = len(timestamps)
+    existing = get_valid_thumbs(screens_tmp)
+    missing = [i for i in range(count) if thumb_name(i) not in existing]
+    frames = {name: frame for name, frame in read_timestamps(screens_tmp).items()
+              if name in existing}
+    stream = get_video_stream(filename)
+    if existing:
+        print('{}: {} thumbnails already done, {} to go'.format(
+            screens_tmp, count - len(missing), len(missing)))
+    if engine == 'single-pass':
+        cmds = []
+        for first, run_length in get_runs(missing):
+            for offset in range(0, run_length, frames_per_job):
+                n = min(frames_per_job, run_length - offset)
+                cmds.append((single_pass_cmd(
+                    filename, orientation, first + offset, n, screens_tmp,
+                    preview_width), n))
+    elif engine == 'keyframe':
+        lowres = stream['codec_name'] in LOWRES_CODECS
+        cmds = [(keyframe_cmd(filename, orientation, i, timestamps[i], screens_tmp,
+                              preview_width, lowres), 1)
+                for i in missing]
+    else:
+        cmds = [(per_frame_cmd(filename, orientation, i, timestamps[i], screens_tmp,
+                               preview_width), 1)
+                for i in missing]
+    return ScreenJob(movie_id, count, screens_tmp, cmds, frames, get_clock(filename))
+
+
+def read_manifest(screens_dir):
+    manifest = screens_dir.joinpath(MANIFEST)
+    if not manifest.exists():
+        return None
+    with manifest.open() as fin:
+        return json.load(fin)
+
+
+def write_manifest(screens_dir):
+    with screens_dir.joinpath(MANIFEST).open('w') as fout:
+        json.dump({'start': C.SCREENSHOT_START, 'frequency': C.SCREENSHOT_FREQUENCY}, fout)
+
+
+def read_timestamps(screens_dir):
+    path = screens_dir.joinpath(TIMESTAMPS)
+    if not path.exists():
+        return {}
+    with path.open() as fin:
+        return json.load(fin)
+
+
+def write_timestamps(screens_dir, timestamps):
+    # written after every command so a resumed run still knows where the
+    # thumbnails that are already done were taken
+    tmp = screens_dir.joinpath(TIMESTAMPS + '.tmp')
+    with tmp.open('w') as fout:
+        json.dump(timestamps, fout, sort_keys=True)
+    os.replace(str(tmp), str(screens_dir.joinpath(TIMESTAMPS)))
+
+
+def is_current(manifest):
+    # screens made before the manifest existed are assumed to be current
+    return (manifest is None or
+            (manifest['start'], manifest['frequency']) ==
+            (C.SCREENSHOT_START, C.SCREENSHOT_FREQUENCY))
+
+
+def get_valid_thumbs(screens_dir):
+    """Return the names of the thumbnails that ffmpeg finished writing.
+
+    Anything else that looks like a thumbnail (empty, or cut off
+    before the JPEG end-of-image marker) is deleted so it gets redone.
+    """
+    valid = set()
+    for path in screens_dir.glob('thumb*.jpg'):
+        if is_complete_jpeg(path):
+            valid.add(path.name)
+        else:
+            print('removing incomplete {}'.format(path))
+            path.unlink()
+    return valid
+
+
+def is_complete_jpeg(path):
+    with path.open('rb') as fin:
+        if fin.read(2) != b'\xff\xd8':
+            return False
+        fin.seek(0, os.SEEK_END)
+        if fin.tell() < 4:
+            return False
+        fin.seek(-2, os.SEEK_END)
+        return fin.read(2) == b'\xff\xd9'
+
+
+def get_runs(indexes):
+    """Group sorted indexes into (first, length) runs of consecutive numbers."""
+    runs = []
+    for i in indexes:
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return [tuple(r) for r in runs]
+
+
+def remap_screens(movie_id, screens_dir, manifest):
+    """Rename thumbnails made with other screenshot constants to the
+    current numbering, in the folder and in the thumbnail table.
+
+    Thumbnails whose timestamp isn't on the new grid are removed.
+    """
+    def new_name(filename):
+        i = int(filename[len('thumb'):-len('.jpg')])
+        ts = manifest['start'] + i * manifest['frequency']
+        offset = ts - C.SCREENSHOT_START
+        if offset < 0 or offset % C.SCREENSHOT_FREQUENCY:
+            return None
+        return thumb_name(offset // C.SCREENSHOT_FREQUENCY)
+
+    renames = []
+    for path in sorted(screens_dir.glob('thumb*.jpg')):
+        name = new_name(path.name)
+        if name is None:
+            path.unlink()
+        else:
+            tmp = path.with_name('remap-' + name)
+            path.rename(tmp)
+            renames.append(tmp)
+    for tmp in renames:
+        tmp.rename(tmp.with_name(tmp.name[len('remap-'):]))
+    snapped = read_timestamps(screens_dir)
+    if snapped:
+        write_timestamps(screens_dir, {
+            new_name(name): ts for name, ts in snapped.items() if new_name(name)})
+
+    db = util.get_db()
+    rows = db.execute(
+        'SELECT id, filename, rating FROM thumbnail WHERE movie_id = ?', (movie_id,)).fetchall()
+    dropped = 0
+    for row in rows:
+        name = new_name(row['filename'])
+        if name is None:
+            dropped += row['rating'] is not None
+            db.execute('DELETE FROM thumbnail WHERE id = ?', (row['id'],))
+        else:
+            db.execute(
+                'UPDATE thumbnail SET filename = ? WHERE id = ?', ('remap-' + name, row['id']))
+    db.execute(
+        "UPDATE thumbnail SET filename = substr(filename, 7) "
+        "WHERE movie_id = ? AND filename LIKE 'remap-%'", (movie_id,))
+    db.commit()
+    if dropped:
+        print('{}: dropped {} ratings that are not on the new screenshot grid'.format(
+            screens_dir, dropped))
+
+
+def run_jobs(jobs, workers):
+    """Run the ffmpeg commands of all `jobs` on a pool of `workers`.
+
+    Commands are queued movie by movie, so a single long movie is
+    spread over all the workers and the next movie starts as soon as a
+    worker frees up. Once every command for a movie has finished its
+    thumbnails are saved with one INSERT batch and screens-tmp is
+    renamed to screens.
+    """
+    remaining = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for job in jobs:
+            remaining[job.movie_id] = len(job.cmds)
+            if not job.cmds:
+                finish_screens(job)
+            for cmd, count in job.cmds:
+                futures[executor.submit(run_cmd, cmd, count)] = job
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                record_frames(job, *future.result())
+                remaining[job.movie_id] -= 1
+                if remaining[job.movie_id] == 0:
+                    finish_screens(job)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def run_cmd(cmd, count):
+    """Run one thumbnail command.
+
+    Returns where the input was seeked to and, per thumbnail written,
+    the (pts, time_base, pts_time) showinfo logged for it.
+    """
+    print(shlex.join(cmd))
+    try:
+        p = util.run(cmd, check=True, stage='thumbnails', items=count,
+                     source_seconds=count * C.SCREENSHOT_FREQUENCY, capture_stderr=True)
+    except subprocess.CalledProcessError as e:
+        if e.stderr:
+            print(e.stderr.decode('utf-8', 'replace'), file=sys.stderr)
+        raise
+    return read_frames(cmd, count, p.stderr)
+
+
+def read_frames(cmd, count, stderr):
+    """Match the frames in a thumbnail command's showinfo log to the
+    thumbnails it wrote; see run_cmd."""
+    if '-start_number' in cmd:
+        first = int(cmd[cmd.index('-start_number') + 1])
+        names = [thumb_name(first + n) for n in range(count)]
+    else:
+        names = [os.path.basename(cmd[-1])]
+    frames = parse_showinfo(stderr.decode('utf-8', 'replace'))
+    return cmd[cmd.index('-ss') + 1], dict(zip(names, frames))
+
+
+def record_frames(job, seek, frames):
+    if frames:
+        job.timestamps.update(
+            (name, locate_frame(job.clock, seek, frame)) for name, frame in frames.items())
+        write_timestamps(job.screens_tmp, job.timestamps)
+
+
+def parse_showinfo(log):
+    """Return (pts, time_base, pts_time) of every frame showinfo logged.
+
+    pts is relative to the seek point and in the time base of the
+    filter's input (None if the log doesn't say), pts_time is the same
+    in seconds but only printed to 6 significant digits.
+    """
+    time_base = None
+    match = re.search(r'config in time_base:\s*(\d+)/(\d+)', log)
+    if match:
+        time_base = fractions.Fraction(int(match.group(1)), int(match.group(2)))
+    return [(int(pts), time_base, float(pts_time)) for pts, pts_time in re.findall(
+        r'n:\s*\d+\s+pts:\s*(-?\d+)\s+pts_time:\s*(-?[0-9.e+-]+)', log)]
+
+
+def locate_frame(clock, seek, frame):
+    """Turn a frame showinfo logged into [ts, pts] in the movie.
+
+    ffmpeg shifts every timestamp back by the seek point (and the
+    file's start_time, the earliest of all its streams), rounded to the
+    stream's time base, so the frame's own pts is that shift plus what
+    showinfo saw.
+    """
+    time_base, start_time = clock
+    rel_pts, rel_time_base, pts_time = frame
+    shift = fractions.Fraction(seek) + start_time
+    if rel_time_base == time_base:
+        pts = round(shift / time_base) + rel_pts
+    else:
+        pts = round((shift + fractions.Fraction(pts_time)) / time_base)
+    return [round(float(pts * time_base - start_time), 6), pts]
+
+
+def finish_screens(job):
+    """Register the thumbnails and move screens_tmp to screens.
+
+    If ffmpeg didn't write all of them, screens_tmp is left where it is
+    so the next run only redoes the gaps; returns the missing names.
+    """
+    names = [thumb_name(i) for i in range(job.count)]
+    valid = get_valid_thumbs(job.screens_tmp)
+    missing = [name for name in names if name not in valid]
+    if missing:
+        print('{}: {} of {} thumbnails missing, leaving it for the next run'.format(
+            job.screens_tmp, len(missing), job.count), file=sys.stderr)
+        return missing
+    with util.timed('register thumbnails', items=job.count):
+        register_thumbnails(job.movie_id, names, job.timestamps)
+    screens = job.screens_tmp.parent.joinpath('screens')
+    shutil.move(str(job.screens_tmp), str(screens))
+    if job.pack:
+        with util.timed('pack thumbnails', items=job.count):
+            packs.pack_screens(job.movie_id, screens)
+    return []
+
+
+def register_thumbnails(movie_id, names, timestamps=None):
+    """Make sure the thumbnail table has exactly one row per thumbnail.
+
+    Rows left by an earlier, interrupted run (or added by qiv-command)
+    are kept; duplicates are collapsed, preferring the rated row.
+    `timestamps` gives the [ts, pts] ffmpeg reported for a thumbnail;
+    ones it doesn't cover get the ts of their slot on the screenshot
+    grid and no pts.
+    """
+    timestamps = timestamps or {}
+    db = util.get_db()
+    rows = db.execute(
+        'SELECT id, filename, rating FROM thumbnail WHERE movie_id = ? '
+        'ORDER BY rating IS NULL, id DESC', (movie_id,))
+    seen = set()
+    duplicates = []
+    for row in rows:
+        if row['filename'] in seen:
+            duplicates.append((row['id'],))
+        seen.add(row['filename'])
+    db.executemany('DELETE FROM thumbnail WHERE id = ?', duplicates)
+    db.executemany(
+        'UPDATE thumbnail SET ts = ?, pts = ? WHERE movie_id = ? AND filename = ?',
+        [(*timestamps[name], movie_id, name)
+         for name in names if name in seen and name in timestamps])
+    db.executemany(
+        'INSERT INTO thumbnail (movie_id, filename, ts, pts) VALUES (?, ?, ?, ?)',
+        [(movie_id, name, *timestamps.get(name, (util.thumb_timestamp(name), None)))
+         for name in names if name not in seen])
+    db.commit()
+
+
+def get_screen_timestamps(duration):
+    return list(range(C.SCREENSHOT_START, int(duration), C.SCREENSHOT_FREQUENCY))
+
+
+def thumb_name(i):
+    return 'thumb{:04d}.jpg'.format(i)
+
+
+def get_video_stream(filename, probe=None):
+    probe = probe or util.probe(filename)
+    for stream in probe['streams']:
+        if stream['codec_type'] == 'video':
+            return stream
+    raise Exception('{} has no video stream'.format(filename))
+
+
+def get_clock(filename):
+    # -ss and the timestamps ffmpeg writes count from the format's
+    # start_time; the video stream's own can be later when the audio
+    # starts first
+    probe = util.probe(filename)
+    stream = get_video_stream(filename, probe)
+    return (fractions.Fraction(stream.get('time_base', '1/1000000')),
+            fractions.Fraction(probe['format'].get('start_time', '0')))
+
+
+def video_filters(orientation, preview_width=None):
+    # only keep the left eye; showinfo logs the pts of every frame that
+    # gets written, which run_cmd reads back
+    filters = 'stereo3d={}l:ml'.format(orientation)
+    if preview_width:
+        filters += ',scale={}:-2'.format(preview_width)
+    return filters + ',showinfo'
+
+
+def per_frame_cmd(filename, orientation, i, ts, screens_dir, preview_width=None):
     # Originally tried using the FPS filter, but I'm not really sure
     # where the first thumbnail starts and so that makes it hard to
     # match thumbnails with timestamps.  This way is slower, but I
     # have more control.
-    screens_tmp.mkdir(exist_ok=False)
-    rng = range(C.SCREENSHOT_START, int(duration), C.SCREENSHOT_FREQUENCY)
-    video_filters = 'stereo3d={}l:ml'.format(orientation)
-    db = util.get_db()
-    cursor = db.cursor()
-    for i, ts in enumerate(rng):
-        thumbnail = screens_tmp.joinpath('thumb{:04d}.jpg'.format(i))
-        cmd = 'ffmpeg -ss {} -i "{}" -vf "{}" -vframes 1 "{}"'.format(
-            ts, filename, video_filters, thumbnail)
-        print(cmd)
-        subprocess.run(shlex.split(cmd), check=True)
-        cursor.execute(
-            'INSERT INTO thumbnail (movie_id, filename) VALUES (?, ?)',
-            (movie_id, thumbnail.name))
-    db.commit()
+    return [
+        *FFMPEG, '-ss', str(ts), '-i', str(filename),
+        '-vf', video_filters(orientation, preview_width),
+        '-vframes', '1', str(screens_dir.joinpath(thumb_name(i)))]
+
+
+def keyframe_cmd(filename, orientation, i, ts, screens_dir, preview_width=None, lowres=False):
+    """Like per_frame_cmd, but only keyframes are decoded.
+
+    -noaccurate_seek stops at the keyframe the seek lands on instead of
+    decoding up to `ts`, so the thumbnail is taken a little before
+    `ts`; the ts stored for it is the keyframe's.
+    """
+    decode = ['-skip_frame', 'nokey', '-noaccurate_seek']
+    if lowres:
+        decode += ['-lowres', '1']
+    return [
+        *FFMPEG, *decode, '-ss', str(ts), '-i', str(filename), '-an',
+        '-vf', video_filters(orientation, preview_width),
+        '-vsync', '0', '-frames:v', '1', str(screens_dir.joinpath(thumb_name(i)))]
+
+
+def single_pass_cmd(filename, orientation, first, count, screens_dir, preview_width=None):
+    """Build an ffmpeg command that writes `count` thumbnails, starting at
+    thumbnail number `first`, while decoding the movie only once.
+
+    The input is seeked (accurately) to the first timestamp, so from
+    there on `t` is relative to that timestamp and the k-th thumbnail
+    is the first frame with t >= k * SCREENSHOT_FREQUENCY. That is the
+    same frame that `ffmpeg -ss <ts>` picks in per-frame mode, so the
+    thumbNNNN.jpg -> timestamp mapping doesn't change.
+    """
+    start = C.SCREENSHOT_START + first * C.SCREENSHOT_FREQUENCY
+    freq = C.SCREENSHOT_FREQUENCY
+    select = (
+        "select='isnan(prev_t)+lt(floor(prev_t/{f}),floor(t/{f}))'".format(f=freq))
+    return [
+        *FFMPEG, '-ss', str(start), '-i', str(filename), '-an',
+        '-vf', '{},{}'.format(select, video_filters(orientation, preview_width)),
+        '-vsync', '0', '-frames:v', str(count), '-start_number', str(first),
+        str(screens_dir.joinpath('thumb%04d.jpg'))]
 
 
 if __name__ == '__main__':
@@ -1,12 +1,10 @@
-import json
 import os
 import pathlib
 import re
-import shlex
-import subprocess
 
 import yaml
 
+import catalog
 import constants as C
 import util
 
@@ -66,7 +64,7 @@ def is_valid_format(fmt):
 
 
 def get_format(fn):
-    base_dir = util.get_folder(fn)
+    base_dir = catalog.get_folder(fn)
     format_file = base_dir.joinpath('format')
     if format_file.exists():
         print('*** moving format to metadata ***')
@@ -86,21 +84,12 @@ def get_format(fn):
 def get_stats(filename):
     keys = ['duration', 'height', 'width']
     fns = [float, int, int]
-    stats = run_ffprobe(filename, keys)
+    stats = run_ffprobe(filename)
     return {k:fn(stats[k]) for k,fn in zip(keys, fns)}
 
 
-def run_ffprobe(fn, entries):
-    entry_str = ','.join(entries)
-    p = subprocess.run(
-            shlex.split('ffprobe -show_entries stream=codec_type,{} -print_format json "{}"'.format(entry_str, fn)),
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    try:
-        out = json.loads(p.stdout.decode('utf-8'))
-    except json.decoder.JSONDecodeError:
-        print(p.stdout.decode('utf-8'))
-        print(p.stderr)
-        raise
+def run_ffprobe(fn):
+    out = util.probe(fn)
     video = next(s for s in out['streams'] if s['codec_type'] == 'video')
     return video
 
@@ -118,7 +107,7 @@ def populate_actress(filename, existing_metadata):
 
 
 def get_actresses(filename):
-    directory = util.get_folder(filename)
+    directory = catalog.get_folder(filename)
     parts = directory.name.split('-')
     actresses = parts[:-1]
     for actress in actresses:
@@ -186,7 +175,7 @@ def populate_title(filename, existing_metadata):
 
 
 def get_title(filename):
-    directory = util.get_folder(filename)
+    directory = catalog.get_folder(filename)
     parts = directory.name.split('-')
     return ' '.join(p.capitalize() for p in parts[-1].split('.'))
 
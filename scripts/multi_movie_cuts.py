@@ -3,14 +3,22 @@ import collections
 import csv
 import datetime
 import os
-import re
+import pathlib
 import random
 import string
-import subprocess
 import sys
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import constants as C
+import intervals
+import keyframes
 import review_screens as rs
+import segments
 import util
 
 
@@ -19,42 +27,132 @@ def main():
     parser.add_argument('--resolution', default='1920x1080')
     parser.add_argument(
         '--duration', default=8*60, type=int, help="length of output compilation, in seconds")
+    parser.add_argument(
+        '--mode', choices=['filter', 'segments'], default='filter',
+        help="filter: one ffmpeg run trims every clip in a filter graph; "
+             "segments: seek to and cut each clip separately, then concatenate them")
+    parser.add_argument(
+        '--max-inputs', type=int, default=10,
+        help="in filter mode, the most clips to decode in one ffmpeg run; longer compilations "
+             "are rendered in groups that are joined at the end (0 for no limit)")
+    parser.add_argument(
+        '--copy', action='store_true',
+        help="in segments mode, stream copy the clips (cuts snap to the previous keyframe and "
+             "--resolution is ignored) if all of the sources have the same codec parameters")
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help="in segments mode, the number of clips to render at the same time")
+    parser.add_argument(
+        '--cache-size', type=float, default=segments.CACHE_SIZE / 1024**3,
+        help="in segments mode, how many GB of rendered clips to keep around")
+    parser.add_argument(
+        '--good-thumbs', choices=['sql', 'numpy', 'python'], default=None,
+        help="how to find runs of positively rated thumbnails")
+    parser.add_argument(
+        '--snap', choices=['keyframe', 'scene'],
+        help="move the start and end of each cut onto the nearest keyframe or scene change "
+             "(see keyframes.py); with keyframes the clips can be stream copied as they are")
+    parser.add_argument(
+        '--snap-tolerance', type=float, default=2.0,
+        help="how many seconds a cut boundary may be moved by --snap")
+    parser.add_argument(
+        '--replay', metavar='COMPILATION',
+        help="render the cuts of an earlier compilation (e.g. collage/collage-....mp4) again "
+             "instead of picking new ones; in segments mode its clips come from the cache")
     args = parser.parse_args()
 
     target_resolution = [int(p) for p in args.resolution.split('x')]
 
-    used_cuts = get_used_cuts()
-    filenames = []
-    filemap = {}
-    metadatas = {}
-
-    # TODO: to really make this work, I'll need to remap from ab to sbs
-    #       and to also make fisheye -> normal mapping
-    #       and probably some sort of normalization to 180 dome. That seems hard, so instead
-    #       we're going to skip the movies that aren't in the most common format (180, sbs, normal)
-    for movie_id, filename, metadata in util.get_file_data():
-        if not rs.is_basic_format(metadata):
-            print('Skipping {} as its not in an easy format'.format(filename))
-            continue
-        filenames.append(filename)
-        filemap[movie_id] = filename
-        metadatas[movie_id] = metadata
-
-    options = list(get_all_good_thumbs())
-    random.shuffle(options)
-
-    timestamps = list(get_timestamps(options, metadatas, used_cuts, args.duration))
-    scale = "{w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2".format(
-        w=int(target_resolution[0]), h=int(target_resolution[1]))
-
+    if args.replay:
+        timestamps = None
+        clips = get_saved_clips(args.replay)
+        if not clips:
+            print('{} has no saved cuts'.format(args.replay), file=sys.stderr)
+            return 1
+    else:
+        timestamps, clips = plan(args)
+    now = datetime.datetime.now()
+    output = 'collage/collage-{}-{}.mp4'.format(now.strftime('%Y%m%d%H%M'), random_string())
+    if args.mode == 'filter':
+        render_filter(clips, target_resolution, output, args.max_inputs)
+    else:
+        copy = args.copy
+        if copy and not segments.can_stream_copy([movie_file for _, movie_file, _ in clips]):
+            print('The sources have different codec parameters, re-encoding instead of copying')
+            copy = False
+        segments.render(clips, target_resolution, output, copy=copy, workers=args.workers,
+                        cache_size=int(args.cache_size * 1024**3))
+    for movie_id, _, _ in clips:
+        print(movie_id)
+    print(output)
+    if timestamps is not None:
+        save_used_cuts(output, timestamps)
+
+
+def plan(args):
+    """Pick new cuts; returns (timestamps, clips), clips in the order
+    they go in the compilation."""
+    with util.timed('plan compilation') as counts:
+        used_cuts = get_used_cuts()
+        # the format is filtered on in sqlite, no metadata JSON is decoded
+        movies = {row['id']: row for row in util.query_movies(**rs.BASIC_FORMAT)}
+        durations = {movie_id: row['duration'] for movie_id, row in movies.items()}
+
+        snap_points = get_snap_points(movies, args.snap) if args.snap else None
+
+        options = lazy_shuffle(list(get_all_good_thumbs(method=args.good_thumbs)))
+
+        timestamps = list(get_timestamps(options, durations, used_cuts, args.duration,
+                                         snap_points, args.snap_tolerance))
+        counts['items'] = len(timestamps)
+    # in the order they go in the compilation, which is also the order
+    # save_used_cuts stores them in
+    timestamps.sort()
+    clips = [(movie_id, util.movie_path(movies[movie_id]), time_slice)
+             for _, time_slice, movie_id in timestamps]
+    return timestamps, clips
+
+
+def render_filter(clips, target_resolution, output, max_inputs=None):
+    """Cut and join `clips`, a list of (movie_id, movie file, time slice),
+    with trim/concat filter graphs.
+
+    Every input of a filter graph has its own decoder, so with more
+    than `max_inputs` clips they are rendered in groups of at most that
+    many, one group at a time, and the groups are then joined with the
+    concat demuxer. That keeps memory use the same however long the
+    compilation is.
+    """
+    if not max_inputs or len(clips) <= max_inputs:
+        p = util.run(filter_graph_cmd(clips, target_resolution, output), stage='filter graph',
+                     items=len(clips), source_seconds=clips_duration(clips))
+        report_rusage('filter graph', p.rusage)
+        return
+    output = pathlib.Path(output)
+    with tempfile.TemporaryDirectory(prefix='groups-', dir=str(output.parent)) as tmp:
+        groups = []
+        for start in range(0, len(clips), max_inputs):
+            group = pathlib.Path(tmp).joinpath('group{:04d}.mp4'.format(len(groups)))
+            group_clips = clips[start:start + max_inputs]
+            cmd = filter_graph_cmd(group_clips, target_resolution, group)
+            p = util.run(cmd, check=True, stage='filter group', items=len(group_clips),
+                         source_seconds=clips_duration(group_clips))
+            report_rusage('group {}'.format(len(groups)), p.rusage)
+            groups.append(group)
+        cmd = segments.concat_cmd(groups, pathlib.Path(tmp).joinpath('groups.txt'), output)
+        print(cmd)
+        p = util.run(cmd, check=True, stage='merge groups', items=len(groups))
+        report_rusage('merge', p.rusage)
+
+
+def filter_graph_cmd(clips, target_resolution, output):
+    scale = segments.scale_filter(target_resolution)
     filter_split = []
     filter_join = []
     vfilter_tmpl = "[{i}:v:0]trim={start}:{end},setpts=PTS-STARTPTS,scale={scale}[v{i}];"
     afilter_tmpl = "[{i}:a:0]atrim={start}:{end},asetpts=PTS-STARTPTS[a{i}];"
     inputs = []
-    for i, item in enumerate(sorted(timestamps)):
-        _, time_slice, movie_id = item
-        movie_file = filemap[movie_id]
+    for i, (_, movie_file, time_slice) in enumerate(clips):
         inputs.append('-i')
         inputs.append(str(movie_file))
         start = time_slice[0]
@@ -67,42 +165,52 @@ def main():
     filter_complex = (
         ''.join(filter_split) +
         ''.join(filter_join) +
-        'concat=n={}:v=1:a=1[outv][outa]'.format(len(timestamps)))
+        'concat=n={}:v=1:a=1[outv][outa]'.format(len(clips)))
     print(filter_complex)
-    now = datetime.datetime.now()
-    output = 'collage/collage-{}-{}.mp4'.format(now.strftime('%Y%m%d%H%M'), random_string())
     cmd = ['ffmpeg'] + inputs + [
         '-filter_complex', filter_complex,
-        '-map', '[outv]', '-map', '[outa]',
-        '-c:v', 'libx264', '-crf', '21', '-profile:v', 'baseline', '-level', '3.0',
-        '-c:a', 'aac', '-b:a', '160k',
-        output]
+        '-map', '[outv]', '-map', '[outa]'] + segments.ENCODE_ARGS + [str(output)]
     print(cmd)
-    subprocess.run(cmd)
-    for item in sorted(timestamps):
-        print(item[2])
-    print(output)
-    save_used_cuts(output, timestamps)
+    return cmd
+
+
+def clips_duration(clips):
+    return sum(end - start for _, _, (start, end) in clips)
+
+
+def report_rusage(stage, rusage):
+    # ru_maxrss is in kilobytes on linux
+    print('{}: peak RSS {:.0f} MB, {:.1f}s CPU'.format(
+        stage, rusage.ru_maxrss / 1024, rusage.ru_utime + rusage.ru_stime))
 
 
 def get_used_cuts():
     """Return cuts that have been used in previous collages.
 
-    Returns: mapping from movie to list of time slices.
+    Returns: mapping from movie to an IntervalIndex of time slices.
     """
-    results = collections.defaultdict(list)
     db = util.get_db()
-    cur = db.execute('SELECT movie_id, start, end FROM used_cuts')
-    for row in cur:
-        time_slice = (float(row['start']), float(row['end']))
-        results[row['movie_id']].append(time_slice)
-    return results
+    cur = db.execute('SELECT movie_id, start, end FROM used_cuts ORDER BY movie_id, start')
+    return intervals.index_by_movie(
+        (row['movie_id'], float(row['start']), float(row['end'])) for row in cur)
+
+
+def get_saved_clips(collage):
+    """The clips (movie_id, movie file, time slice) of an earlier
+    compilation, as save_used_cuts stored them."""
+    names = [collage, 'collage/' + os.path.basename(collage)]
+    db = util.get_db()
+    cur = db.execute(
+        'SELECT u.movie_id, m.folder, m.filename, u.start, u.end FROM used_cuts u '
+        'INNER JOIN movie m ON u.movie_id = m.id '
+        'WHERE u.collage IN (?, ?) ORDER BY u.id', names)
+    return [(row['movie_id'], util.movie_path(row), (row['start'], row['end'])) for row in cur]
 
 
 def save_used_cuts(collage, timestamps):
     db = util.get_db()
     cur = db.cursor()
-    for movie_id, time_slice, _ in timestamps:
+    for _, time_slice, movie_id in timestamps:
         cur.execute('INSERT INTO used_cuts (collage, movie_id, start, end) VALUES (?, ?, ?, ?)',
                     (collage, movie_id, time_slice[0], time_slice[1]))
     db.commit()
@@ -112,9 +220,9 @@ def random_string(n=6):
     return ''.join([random.choice(string.ascii_lowercase) for _ in range(n)])
 
 
-def get_all_good_thumbs(n=1):
-    """Returns thumbnails that are rated positively AND are surrounded
-    by positive ones.
+def get_all_good_thumbs(n=1, method=None):
+    """Returns (movie_id, ts) of the thumbnails that are rated
+    positively AND are surrounded by positive ones.
 
     For example, if we have:
     0123
@@ -129,22 +237,101 @@ def get_all_good_thumbs(n=1):
         n: number of thumbs before and after that are needed. If,
            for example n=2 then 5 positive thumbnails in a row would be
            needed. (2 before, the middle one, 2 after)
+        method: 'python' walks each movie's thumbnails in filename
+           order. 'sql' (a window function inside sqlite) and 'numpy'
+           only read the positive ratings and use the thumbnail numbers
+           to tell whether they are consecutive. They give the same
+           thumbnails as long as every thumbnail of a movie has a row,
+           which make_thumbs makes sure of. Defaults to 'numpy' if it
+           is installed, 'sql' otherwise.
     """
+    if method is None:
+        method = 'sql' if np is None else 'numpy'
+    if method == 'sql':
+        rows = get_good_thumbs_sql(n)
+    elif method == 'numpy':
+        rows = get_good_thumbs_numpy(n)
+    else:
+        rows = get_good_thumbs_python(n)
+    return rows
+
+
+def get_good_thumbs_python(n):
     thumbs_by_movie = collections.defaultdict(list)
     for row in get_all_thumbs():
-        thumbs_by_movie[(row['id'], row['folder'])].append((row['filename'], row['rating']))
-    for (movie_id, folder), thumbs in thumbs_by_movie.items():
-        for good_thumb in bracketed_good_thumbs(thumbs, n):
-            yield movie_id, C.RAWDIR.joinpath(folder, 'screens', good_thumb)
+        thumbs_by_movie[row['movie_id']].append((row['filename'], row['rating'], row['ts']))
+    for movie_id, thumbs in thumbs_by_movie.items():
+        for _, _, ts in bracketed_good_thumbs(thumbs, n):
+            yield movie_id, ts
+
+
+def get_good_thumbs_sql(n):
+    # Only the positive rows are read (through the partial index). The
+    # run around a thumbnail is complete when the positive thumbnails n
+    # rows before and n rows after it are exactly n thumbnails away.
+    db = util.get_db()
+    cur = db.cursor()
+    cur.row_factory = None
+    yield from cur.execute("""
+        select movie_id, ts
+        from (
+            select movie_id, ts,
+                lag(number, {n:d}) over w as first,
+                lead(number, {n:d}) over w as last
+            from (
+                select movie_id, ts,
+                    cast(substr(filename, 6, length(filename) - 9) as integer) as number
+                from thumbnail
+                where rating = 1
+            )
+            window w as (partition by movie_id order by number)
+        )
+        where last - first = {span:d}
+    """.format(n=n, span=2*n))
+
+
+def get_good_thumbs_numpy(n):
+    if np is None:
+        raise Exception('numpy is not installed, use another method')
+    db = util.get_db()
+    # sqlite hands back one comma separated string of positive
+    # thumbnail numbers per movie, which is a lot cheaper than a row
+    # per thumbnail
+    cur = db.cursor()
+    cur.row_factory = None
+    rows = cur.execute("""
+        select movie_id, count(*),
+            group_concat(substr(filename, 6, length(filename) - 9)), group_concat(ts)
+        from thumbnail
+        where rating = 1
+        group by movie_id
+    """).fetchall()
+    if not rows:
+        return
+    movie_ids = np.repeat(
+        np.array([r[0] for r in rows], dtype=np.int64), [r[1] for r in rows])
+    numbers = np.array(','.join(r[2] for r in rows).split(','), dtype=np.int64)
+    # both group_concats see the rows in the same order
+    timestamps = np.array(','.join(r[3] for r in rows).split(','), dtype=np.float64)
+    order = np.lexsort((numbers, movie_ids))
+    movie_ids, numbers, timestamps = movie_ids[order], numbers[order], timestamps[order]
+    # with the positive thumbnails sorted, the one at i is the center of
+    # a run when the ones at i-n and i+n are in the same movie and
+    # exactly n thumbnails away
+    span = 2*n
+    if len(numbers) <= span:
+        return
+    complete = ((numbers[span:] - numbers[:-span] == span) &
+                (movie_ids[span:] == movie_ids[:-span]))
+    centers = np.flatnonzero(complete) + n
+    yield from zip(movie_ids[centers].tolist(), timestamps[centers].tolist())
 
 
 def get_all_thumbs():
     db = util.get_db()
     cur = db.execute("""
-        select m.id, folder, t.filename, rating
-        from thumbnail t
-        inner join movie m
-        on t.movie_id = m.id
+        select movie_id, filename, rating, ts
+        from thumbnail
     """)
     yield from cur
 
@@ -153,8 +340,8 @@ def bracketed_good_thumbs(thumbs, n=1):
     series_length = 2*n + 1
     thumbs = sorted(thumbs, key=lambda t: t[0])
     good_thumbs = []
-    for thumb, rating in thumbs:
-        if rating == 1:
+    for thumb in thumbs:
+        if thumb[1] == 1:
             good_thumbs.append(thumb)
         else:
             good_thumbs = []
@@ -162,33 +349,75 @@ def bracketed_good_thumbs(thumbs, n=1):
             yield good_thumbs[-(n + 1)]
 
 
-def get_timestamps(thumbnails, metadatas, all_excludes, target_duration):
+def lazy_shuffle(items):
+    """Yield `items` in random order, shuffling only as far as the caller reads.
+
+    This is a Fisher-Yates shuffle done one step per item, so every
+    order is as likely as with random.shuffle. `items` is reordered in
+    place.
+    """
+    for end in range(len(items) - 1, -1, -1):
+        i = random.randint(0, end)
+        items[i], items[end] = items[end], items[i]
+        yield items[end]
+
+
+def get_snap_points(movie_ids, kind):
+    """Return movie_id -> sorted times to snap the cuts of that movie to,
+    `kind` being 'keyframe' or 'scene'."""
+    points = {}
+    for movie_id, index in keyframes.get_indexes(movie_ids).items():
+        times = index.keyframes if kind == 'keyframe' else index.scenes
+        if times:
+            points[movie_id] = times
+    missing = len(set(movie_ids) - set(points))
+    if missing:
+        print('{} movies have no {} index, their cuts are not snapped (run keyframes.py{})'.format(
+            missing, kind, ' --scenes' if kind == 'scene' else ''))
+    return points
+
+
+def get_timestamps(thumbnails, durations, all_excludes, target_duration, snap_points=None,
+                   snap_tolerance=2.0):
     """Yield clips from movies.
 
     Returns: list of (normalized_position, time_slice, movie_id) tuples
 
     Args:
-        thumbnails: list of (movie_id, thumbnail paths)
-        metadatas: mapping from movie_id -> metadata
-        all_excludes: mapping from movie_id -> cuts to exclude
+        thumbnails: iterable of (movie_id, thumbnail ts), in random order.
+           It is only read until there are enough clips.
+        durations: mapping from movie_id -> duration, of the movies in
+           the basic format. Thumbnails of other movies are skipped.
+        all_excludes: mapping from movie_id -> IntervalIndex of cuts to exclude
         target_duration: how long the resulting output should be, in seconds
+        snap_points: mapping from movie_id -> sorted times (keyframes or
+           scene changes) that the cut boundaries are moved to when one
+           is within `snap_tolerance` seconds
     """
     used_movies = set()
     total_duration = 0
-    for movie_id, thumb in thumbnails:
-        assert thumb.parent.name == 'screens'
+    for movie_id, ts in thumbnails:
         # avoid having the same movie twice. Its more intersting and
         # its easier as I don't have to check for overlap
         if movie_id in used_movies:
             continue
-        metadata = metadatas[movie_id]
-        duration = metadata['video']['duration']
-        ts = get_screen_timestamp(str(thumb))
+        # TODO: to really make this work, I'll need to remap from ab to sbs
+        #       and to also make fisheye -> normal mapping
+        #       and probably some sort of normalization to 180 dome. That seems hard, so instead
+        #       we're going to skip the movies that aren't in the most common format (180, sbs, normal)
+        if movie_id not in durations:
+            print('Skipping movie {} as its not in an easy format'.format(movie_id))
+            used_movies.add(movie_id)
+            continue
+        duration = durations[movie_id]
         ts_slice = get_slice(ts)
+        if snap_points and movie_id in snap_points:
+            ts_slice = snap_slice(ts_slice, snap_points[movie_id], snap_tolerance)
         ts_slice = clip(ts_slice, 0, duration)
         excludes = all_excludes[movie_id]
-        if has_overlap(ts_slice, excludes):
+        if excludes.overlaps(ts_slice):
             continue
+        excludes.add(*ts_slice)
         used_movies.add(movie_id)
         # ts / duration gives the normalized position
         yield (ts / duration, ts_slice, movie_id)
@@ -199,6 +428,7 @@ def get_timestamps(thumbnails, metadatas, all_excludes, target_duration):
 
 
 def has_overlap(candidate, existing):
+    """Plain scan over `existing`, kept as the reference for IntervalIndex.overlaps"""
     for slice_ in existing:
         for part in candidate:
             if slice_[0] <= part <= slice_[1]:
@@ -215,13 +445,16 @@ def get_slice(base):
     return ts
 
 
-def clip(arr, min_val, max_val):
-    return [min(max_val, max(min_val, a)) for a in arr]
+def snap_slice(ts_slice, points, tolerance):
+    snapped = [keyframes.snap(t, points, tolerance) for t in ts_slice]
+    # both ends landing on the same point would leave nothing to cut
+    if snapped[0] >= snapped[1]:
+        return ts_slice
+    return snapped
 
 
-def get_screen_timestamp(screen):
-    match = re.match('thumb(\d\d\d\d).jpg', os.path.basename(screen))
-    return int(match.group(1)) * C.SCREENSHOT_FREQUENCY + C.SCREENSHOT_START
+def clip(arr, min_val, max_val):
+    return [min(max_val, max(min_val, a)) for a in arr]
 
 
 if __name__ == '__main__':
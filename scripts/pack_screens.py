@@ -0,0 +1,34 @@
+"""Move existing screens/ folders into screens.pack files (or back)"""
+import argparse
+import sys
+
+import constants as C
+import packs
+import util
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--unpack', action='store_true', help="turn packs back into thumbNNNN.jpg files")
+    args = parser.parse_args()
+
+    with util.timed('pack screens' if not args.unpack else 'unpack screens',
+                    items=0) as counts:
+        for row in util.query_movies():
+            screens = C.RAWDIR.joinpath(row['folder'], 'screens')
+            if not screens.exists():
+                continue
+            if args.unpack:
+                count = packs.unpack_screens(row['id'], screens)
+            elif any(screens.glob('thumb*.jpg')):
+                count = packs.pack_screens(row['id'], screens)
+            else:
+                continue
+            if count:
+                print('{}: {} thumbnails'.format(screens, count))
+            counts['items'] += count
+
+
+if __name__ == '__main__':
+    sys.exit(main())
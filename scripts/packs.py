@@ -0,0 +1,164 @@
+"""Packed screens: all of a movie's thumbnails in one file.
+
+screens/screens.pack is the movie's thumbNNNN.jpg files one after the
+other; where each one starts and how long it is are the pack_offset
+and pack_length columns of its thumbnail row. Tiles are read straight
+out of a memory map of the pack. qiv needs real files, so the
+thumbnails picked for review are written to screens-review/ in the
+movie folder while qiv is open.
+"""
+import collections
+import contextlib
+import mmap
+import os
+import shutil
+
+import catalog
+import constants as C
+import util
+
+PACK = 'screens.pack'
+
+# the most packs kept mapped at once
+OPEN_PACKS = 64
+
+
+def pack_path(screens_dir):
+    return screens_dir.joinpath(PACK)
+
+
+def is_packed(screens_dir):
+    return pack_path(screens_dir).exists()
+
+
+def pack_screens(movie_id, screens_dir):
+    """Move the thumbnails in screens_dir into its pack and delete them.
+
+    Thumbnails already in the pack are carried over. Returns how many
+    thumbnails the pack holds.
+    """
+    pack = pack_path(screens_dir)
+    tiles = dict(read_pack(movie_id, screens_dir)) if pack.exists() else {}
+    files = sorted(screens_dir.glob('thumb*.jpg'))
+    for path in files:
+        tiles[path.name] = path.read_bytes()
+    rows = []
+    tmp = pack.with_name(PACK + '.tmp')
+    with tmp.open('wb') as fout:
+        for name in sorted(tiles):
+            rows.append((fout.tell(), len(tiles[name]), movie_id, name))
+            fout.write(tiles[name])
+        fout.flush()
+        os.fsync(fout.fileno())
+    db = util.get_db()
+    with util.transaction(db):
+        # thumbnails nobody has registered yet get a row, like make_thumbs would
+        db.executemany(
+            'INSERT OR IGNORE INTO thumbnail (movie_id, filename, ts) VALUES (?, ?, ?)',
+            [(movie_id, name, util.thumb_timestamp(name)) for _, _, _, name in rows])
+        db.executemany(
+            'UPDATE thumbnail SET pack_offset = ?, pack_length = ? '
+            'WHERE movie_id = ? AND filename = ?', rows)
+        os.replace(str(tmp), str(pack))
+    forget(pack)
+    # only once the pack and its offsets are safely in place
+    for path in files:
+        path.unlink()
+    return len(rows)
+
+
+def unpack_screens(movie_id, screens_dir):
+    """Write the thumbnails in screens_dir's pack back out as files and
+    remove the pack."""
+    pack = pack_path(screens_dir)
+    if not pack.exists():
+        return 0
+    count = 0
+    for name, data in read_pack(movie_id, screens_dir):
+        screens_dir.joinpath(name).write_bytes(data)
+        count += 1
+    db = util.get_db()
+    with util.transaction(db):
+        db.execute(
+            'UPDATE thumbnail SET pack_offset = NULL, pack_length = NULL WHERE movie_id = ?',
+            (movie_id,))
+    forget(pack)
+    pack.unlink()
+    return count
+
+
+def read_pack(movie_id, screens_dir):
+    """Yield (thumbnail name, JPEG bytes) of every tile in a pack."""
+    pack = pack_path(screens_dir)
+    rows = util.get_db().execute(
+        'SELECT filename, pack_offset, pack_length FROM thumbnail '
+        'WHERE movie_id = ? AND pack_offset IS NOT NULL ORDER BY filename',
+        (movie_id,)).fetchall()
+    for row in rows:
+        yield row['filename'], read_tile(pack, row['pack_offset'], row['pack_length'])
+
+
+_maps = collections.OrderedDict()
+
+
+def read_tile(pack, offset, length):
+    """Return `length` bytes at `offset` of a pack, through a memory map."""
+    key = str(pack)
+    m = _maps.pop(key, None)
+    if m is None:
+        with open(key, 'rb') as fin:
+            m = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        while len(_maps) >= OPEN_PACKS:
+            _maps.popitem(last=False)[1].close()
+    _maps[key] = m
+    return m[offset:offset + length]
+
+
+def forget(pack):
+    """Drop the memory map of a pack that was just rewritten or removed."""
+    m = _maps.pop(str(pack), None)
+    if m is not None:
+        m.close()
+
+
+def get_tile(thumbnail):
+    """Return the JPEG bytes of RAWDIR/<folder>/screens/thumbNNNN.jpg,
+    whether it is a file or in the movie's pack."""
+    if thumbnail.exists():
+        return thumbnail.read_bytes()
+    movie = catalog.get_catalog().find(thumbnail)
+    row = movie and util.get_db().execute(
+        'SELECT pack_offset, pack_length FROM thumbnail '
+        'WHERE movie_id = ? AND filename = ? AND pack_offset IS NOT NULL',
+        (movie.id, thumbnail.name)).fetchone()
+    if row is None:
+        raise FileNotFoundError(thumbnail)
+    return read_tile(pack_path(thumbnail.parent), row['pack_offset'], row['pack_length'])
+
+
+@contextlib.contextmanager
+def extracted(thumbnails):
+    """Make sure every one of `thumbnails` is a file for the with block.
+
+    Yields the list of paths to use instead: the thumbnail itself if it
+    is a file, otherwise a copy in the movie's screens-review/ that is
+    removed again afterwards.
+    """
+    paths = []
+    review_dirs = set()
+    try:
+        for thumbnail in thumbnails:
+            thumbnail = C.RAWDIR.joinpath(thumbnail)
+            if thumbnail.exists():
+                paths.append(thumbnail)
+                continue
+            review_dir = thumbnail.parent.parent.joinpath('screens-review')
+            review_dir.mkdir(exist_ok=True)
+            review_dirs.add(review_dir)
+            path = review_dir.joinpath(thumbnail.name)
+            path.write_bytes(get_tile(thumbnail))
+            paths.append(path)
+        yield paths
+    finally:
+        for review_dir in review_dirs:
+            shutil.rmtree(str(review_dir), ignore_errors=True)
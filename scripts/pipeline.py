@@ -0,0 +1,184 @@
+"""Ingest the library in one go: metadata, thumbnails and registration.
+
+Every movie folder goes through
+  probe/metadata -> plan thumbnails -> ffmpeg -> register thumbnails
+on its own, so the first movies are getting thumbnails while later
+ones are still being probed. ffprobe and ffmpeg run as asyncio
+subprocesses, each with its own limit on how many run at once, and
+only --in-flight movies are in the pipeline at any time. All database
+work happens on the event loop's thread.
+
+A movie that fails is reported and skipped; the rest carry on.
+"""
+import argparse
+import asyncio
+import os
+import shlex
+import subprocess
+import sys
+import traceback
+
+import catalog
+import constants as C
+import make_thumbs
+import metadata as mm
+import save_metadata
+import util
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="only re-read the metadata of folders that are new or changed")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    pipeline = from_args(args)
+    with util.timed('pipeline', items=0) as counts:
+        counts['items'] = ingest_library(pipeline, args.incremental)
+    if pipeline.failed:
+        pipeline.report_failures()
+        return 1
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--probe-workers', type=int, default=4,
+        help="number of ffprobe processes to run at the same time")
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help="number of ffmpeg processes to run at the same time")
+    parser.add_argument(
+        '--in-flight', type=int,
+        help="most movies in the pipeline at once (default: twice --workers)")
+    parser.add_argument(
+        '--engine', choices=['single-pass', 'per-frame', 'keyframe'], default='single-pass',
+        help="see make_thumbs.py")
+    parser.add_argument('--frames-per-job', type=int, default=40, help="see make_thumbs.py")
+    parser.add_argument('--preview-width', type=int, help="see make_thumbs.py")
+    parser.add_argument('--pack', action='store_true', help="see make_thumbs.py")
+
+
+def from_args(args):
+    """Make a Pipeline from the options add_arguments added."""
+    preview_width = args.preview_width
+    if preview_width is None and args.engine == 'keyframe':
+        preview_width = make_thumbs.KEYFRAME_PREVIEW_WIDTH
+    return Pipeline(
+        args.probe_workers, args.workers, args.in_flight or 2 * args.workers,
+        engine=args.engine, frames_per_job=args.frames_per_job, preview_width=preview_width,
+        pack=args.pack)
+
+
+def ingest_library(pipeline, incremental=False):
+    """Run every movie folder through `pipeline`; returns how many there are."""
+    changed = set(save_metadata.get_changed_dirs(incremental))
+    folders = [(dirpath, dirpath in changed) for dirpath in save_metadata.get_movie_dirs()]
+    asyncio.run(pipeline.run(folders))
+    return len(folders)
+
+
+class Pipeline:
+
+    def __init__(self, probe_workers, workers, in_flight, **thumb_options):
+        self.probe_workers = probe_workers
+        self.workers = workers
+        self.in_flight = in_flight
+        self.thumb_options = thumb_options
+        # (folder, exception) of the movies that failed
+        self.failed = []
+
+    def report_failures(self):
+        print('{} movies failed:'.format(len(self.failed)), file=sys.stderr)
+        for dirpath, error in self.failed:
+            print('  {}: {}'.format(dirpath, error), file=sys.stderr)
+
+    async def run(self, folders):
+        """Push (folder, metadata changed) pairs through the stages."""
+        # the semaphores have to be made inside the running loop
+        self.probe_slots = asyncio.Semaphore(self.probe_workers)
+        self.ffmpeg_slots = asyncio.Semaphore(self.workers)
+        movie_slots = asyncio.Semaphore(self.in_flight)
+        tasks = set()
+        for dirpath, changed in folders:
+            # backpressure: wait for a movie to leave the pipeline
+            await movie_slots.acquire()
+            task = asyncio.create_task(self.ingest(dirpath, changed))
+            tasks.add(task)
+            task.add_done_callback(lambda t: (movie_slots.release(), tasks.discard(t)))
+        await asyncio.gather(*tasks)
+
+    async def ingest(self, dirpath, changed):
+        try:
+            if changed:
+                movie_id = await self.save_metadata(dirpath)
+            else:
+                movie_id = get_movie_id(dirpath)
+            if movie_id is None:
+                return
+            await self.make_thumbs(movie_id)
+        except Exception as e:
+            util.get_db().rollback()
+            traceback.print_exc()
+            self.failed.append((dirpath, e))
+
+    async def save_metadata(self, dirpath):
+        metadata = mm.get_override_metadata(dirpath)
+        moviefile = save_metadata.get_movie_file(dirpath, metadata)
+        if 'video' not in metadata:
+            # warm the probe cache, so save_folder doesn't block on ffprobe
+            async with self.probe_slots:
+                await util.probe_async(moviefile)
+        movie_id = save_metadata.save_folder(dirpath)
+        util.get_db().commit()
+        return movie_id
+
+    async def make_thumbs(self, movie_id):
+        row = util.get_db().execute(
+            'SELECT id, folder, filename, duration, orientation FROM movie WHERE id = ?',
+            (movie_id,)).fetchone()
+        # planning reads the video stream from the probe; make sure that is
+        # in the cache, even for unchanged folders and metadata.yaml with
+        # a 'video' entry, so ffprobe never runs on the event loop's thread
+        async with self.probe_slots:
+            await util.probe_async(util.movie_path(row))
+        job = make_thumbs.plan_movie(row, **self.thumb_options)
+        if job is None:
+            return
+        cmds = [asyncio.create_task(self.run_cmd(job, cmd, count)) for cmd, count in job.cmds]
+        try:
+            await asyncio.gather(*cmds)
+        except BaseException:
+            for task in cmds:
+                task.cancel()
+            await asyncio.gather(*cmds, return_exceptions=True)
+            raise
+        if make_thumbs.finish_screens(job):
+            raise Exception('ffmpeg left thumbnails out of {}'.format(job.screens_tmp))
+
+    async def run_cmd(self, job, cmd, count):
+        async with self.ffmpeg_slots:
+            print(shlex.join(cmd))
+            try:
+                p = await util.run_async(
+                    cmd, check=True, stage='thumbnails', items=count,
+                    source_seconds=count * C.SCREENSHOT_FREQUENCY, capture_stderr=True)
+            except subprocess.CalledProcessError as e:
+                if e.stderr:
+                    print(e.stderr.decode('utf-8', 'replace'), file=sys.stderr)
+                raise
+        make_thumbs.record_frames(job, *make_thumbs.read_frames(cmd, count, p.stderr))
+
+
+def get_movie_id(dirpath):
+    movie = catalog.get_catalog().get_folder_movie(dirpath.name)
+    if movie is None:
+        print('{} has not been saved yet, run without --incremental'.format(dirpath),
+              file=sys.stderr)
+        return None
+    return movie.id
+
+
+if __name__ == '__main__':
+    sys.exit(main())
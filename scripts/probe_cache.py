@@ -0,0 +1,48 @@
+"""Inspect and maintain the cached ffprobe results in data.db"""
+import argparse
+import pathlib
+import sys
+
+import catalog
+import util
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help="show the cached files")
+    invalidate = subparsers.add_parser(
+        'invalidate', help="drop cached results (all of them if no files are given)")
+    invalidate.add_argument('files', nargs='*', type=pathlib.Path)
+    refresh = subparsers.add_parser(
+        'refresh', help="re-run ffprobe (on every movie in the db if no files are given)")
+    refresh.add_argument('files', nargs='*', type=pathlib.Path)
+    subparsers.add_parser('prune', help="drop results for files that no longer exist")
+    args = parser.parse_args()
+
+    db = util.get_db()
+    if args.command == 'list':
+        for row in db.execute('SELECT path, size, mtime_ns FROM probe_cache ORDER BY path'):
+            print('{}\t{}\t{}'.format(row['path'], row['size'], row['mtime_ns']))
+    elif args.command == 'invalidate':
+        if args.files:
+            db.executemany('DELETE FROM probe_cache WHERE path = ?',
+                           [(str(f.resolve()),) for f in args.files])
+        else:
+            db.execute('DELETE FROM probe_cache')
+        db.commit()
+    elif args.command == 'refresh':
+        files = args.files or [movie.path for movie in catalog.get_catalog()]
+        for filename in files:
+            print(filename)
+            util.probe(filename, refresh=True)
+    elif args.command == 'prune':
+        paths = [row['path'] for row in db.execute('SELECT path FROM probe_cache')]
+        missing = [(p,) for p in paths if not pathlib.Path(p).exists()]
+        db.executemany('DELETE FROM probe_cache WHERE path = ?', missing)
+        db.commit()
+        print('removed {} stale entries'.format(len(missing)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
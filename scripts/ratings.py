@@ -0,0 +1,270 @@
+"""Write the ratings made in qiv to data.db in batches.
+
+qiv starts qiv-command for every key press. Instead of each of those
+opening the database, qiv-command hands its rating to a server
+listening on data/rating.sock, which writes what it has been sent in
+one transaction every half second. review_screens.py runs a server
+for as long as qiv is open; `ratings.py serve` runs one on its own.
+
+Ratings sent while no server is running are appended to
+data/ratings.spool and written when the next server starts, or by
+`ratings.py flush`.
+"""
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+
+import catalog
+import constants as C
+import util
+
+FLUSH_INTERVAL = 0.5
+# how long qiv-command waits for the server before spooling instead
+SEND_TIMEOUT = 1
+# how long a flush waits for make_thumbs and friends to let go of the db
+DB_TIMEOUT = 30
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', help="write ratings sent by qiv-command until interrupted")
+    subparsers.add_parser('flush', help="write the spooled ratings")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = RatingServer()
+        # stop cleanly on SIGTERM too, so the pending ratings and the
+        # timings are written
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        print('listening on {}'.format(socket_path()))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'flush':
+        print('wrote {} spooled ratings'.format(drain_spool(util.get_db())))
+
+
+def socket_path():
+    return C.DATADIR.joinpath('rating.sock')
+
+
+def spool_path():
+    return C.DATADIR.joinpath('ratings.spool')
+
+
+def send(filename, rating):
+    """Hand a rating to the server, or spool it if none is running.
+
+    Returns 'server' or 'spool', depending on where it went.
+    """
+    message = (json.dumps({'filename': str(filename), 'rating': rating}) + '\n').encode()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # a busy or wedged server mustn't hold up qiv
+            sock.settimeout(SEND_TIMEOUT)
+            sock.connect(str(socket_path()))
+            sock.sendall(message)
+            # the server answers once the rating is queued
+            if sock.recv(16) == b'ok\n':
+                return 'server'
+    except OSError:
+        # no server, or it timed out or hung up; the spool still works
+        pass
+    spool([(filename, rating)])
+    return 'spool'
+
+
+def spool(ratings):
+    """Append (thumbnail path, rating)s to the spool."""
+    message = ''.join(json.dumps({'filename': str(filename), 'rating': rating}) + '\n'
+                      for filename, rating in ratings).encode()
+    # a single O_APPEND write, so concurrent senders don't interleave
+    fd = os.open(str(spool_path()), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, message)
+    finally:
+        os.close(fd)
+
+
+def is_serving():
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path()))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+
+@contextlib.contextmanager
+def serving():
+    """Run a server in a thread for the with block, unless one is
+    already running."""
+    if is_serving():
+        yield
+        return
+    server = RatingServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while not server.ready.wait(0.1):
+        if not thread.is_alive():
+            raise Exception('the rating server did not start')
+    try:
+        yield
+    finally:
+        server.stop()
+        thread.join()
+
+
+class RatingServer:
+    """Accept ratings on socket_path() and write them in batches.
+
+    The server opens its own connection, in whichever thread runs
+    serve_forever.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+
+    def serve_forever(self):
+        db = util.connect(C.DATADIR.joinpath('data.db'), timeout=DB_TIMEOUT)
+        path = socket_path()
+        if is_serving():
+            raise Exception('a rating server is already listening on {}'.format(path))
+        if path.exists():
+            # left behind by a server that didn't shut down cleanly
+            path.unlink()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(str(path))
+            sock.listen()
+            sock.settimeout(self.flush_interval)
+            self.ready.set()
+            try:
+                # only drained once we are listening, so nothing can be
+                # spooled after this without being seen by the next server
+                self.drain(db)
+                while not self.stopping.is_set():
+                    try:
+                        conn, _ = sock.accept()
+                    except socket.timeout:
+                        self.flush(db)
+                        continue
+                    with conn:
+                        self.receive(conn)
+                    if len(self.pending) >= 100:
+                        self.flush(db)
+            finally:
+                path.unlink()
+                self.flush(db, final=True)
+                self.drain(db)
+                db.close()
+
+    def receive(self, conn):
+        conn.settimeout(1)
+        data = b''
+        try:
+            while not data.endswith(b'\n'):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            for line in data.splitlines():
+                message = json.loads(line)
+                self.pending.append((pathlib.Path(message['filename']), message['rating']))
+            conn.sendall(b'ok\n')
+        except (OSError, ValueError) as e:
+            print('dropping a bad rating message: {}'.format(e), file=sys.stderr)
+
+    def flush(self, db, final=False):
+        if not self.pending:
+            return
+        ratings, self.pending = self.pending, []
+        try:
+            with util.timed('write ratings', items=len(ratings)):
+                written = write_ratings(db, ratings)
+        except sqlite3.OperationalError as e:
+            # most likely another script holding the write lock; the
+            # batch is tried again on the next flush, or spooled if
+            # there won't be one
+            print('could not write {} ratings: {}'.format(len(ratings), e), file=sys.stderr)
+            if final:
+                spool(ratings)
+            else:
+                self.pending[:0] = ratings
+            return
+        for filename, rating in written:
+            print('SUCCESS: added rating {} for {} to db'.format(rating, filename))
+
+    def drain(self, db):
+        try:
+            drain_spool(db)
+        except sqlite3.OperationalError as e:
+            # the spool is left where it is for the next drain
+            print('could not write the spooled ratings: {}'.format(e), file=sys.stderr)
+
+    def stop(self):
+        self.stopping.set()
+
+
+def write_ratings(db, ratings):
+    """Write a list of (thumbnail path, rating) in one transaction.
+
+    Returns the ones that were written; thumbnails of movies that
+    aren't in the db are skipped.
+    """
+    movies = catalog.get_catalog(db)
+    written = []
+    with util.transaction(db):
+        for filename, rating in ratings:
+            try:
+                movie = movies.find(filename, db)
+            except Exception as e:
+                print('{}, skipping its rating'.format(e), file=sys.stderr)
+                continue
+            if movie is None:
+                print('{} is not in the db, skipping its rating'.format(filename),
+                      file=sys.stderr)
+                continue
+            movie_id = movie.id
+            cur = db.execute(
+                'UPDATE thumbnail SET rating = ? WHERE movie_id = ? AND filename = ?',
+                (rating, movie_id, filename.name))
+            if cur.rowcount == 0:
+                db.execute(
+                    'INSERT INTO thumbnail (movie_id, filename, rating, ts) VALUES (?, ?, ?, ?)',
+                    (movie_id, filename.name, rating, util.thumb_timestamp(filename.name)))
+            written.append((filename, rating))
+    return written
+
+
+def drain_spool(db):
+    """Write the spooled ratings; returns how many there were."""
+    spool = spool_path()
+    draining = spool.with_name(spool.name + '.draining')
+    count = 0
+    # a .draining file is left if the last drain died part way through;
+    # ratings are idempotent, so it is simply written again
+    while draining.exists() or spool.exists():
+        if not draining.exists():
+            spool.rename(draining)
+        with draining.open() as fin:
+            ratings = [json.loads(line) for line in fin if line.strip()]
+        write_ratings(db, [(pathlib.Path(r['filename']), r['rating']) for r in ratings])
+        draining.unlink()
+        count += len(ratings)
+    return count
+
+
+if __name__ == '__main__':
+    sys.exit(main())
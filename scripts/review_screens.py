@@ -1,39 +1,79 @@
 import argparse
+import heapq
+import itertools
 import random
 import os
 import subprocess
 import sys
 
 import constants as C
+import make_thumbs
+import packs
+import ratings
 import util
 
+# the movie format that review and the compilations stick to, as
+# util.query_movies keywords
+BASIC_FORMAT = {'fov': '180', 'orientation': 'sbs', 'perspective': 'normal'}
+
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--batch-size', type=int, default=100, help="number of screens to review")
     args = parser.parse_args()
 
-    all_screens = dict(get_all_screens())
+    # ratings made while no rating server was running
+    ratings.drain_spool(util.get_db())
+    with util.timed('load screens') as counts:
+        all_screens = {k: MovieScreens(v) for k, v in get_all_screens()}
+        counts['items'] = sum(len(v) for v in all_screens.values())
+    with util.timed('pick candidates') as counts:
+        candidates = pick_candidates(all_screens, args.batch_size)
+        counts['items'] = len(candidates)
+    env = {k: v for k, v in os.environ.items()}
+    env['PATH'] = str(C.SCRIPTSDIR) + ':' + env['PATH']
+    # thumbnails in a screens.pack are written out for qiv while it runs
+    with packs.extracted(candidates) as paths, ratings.serving():
+        cmd = ['qiv', '-CtS'] + [str(p) for p in paths]
+        print(cmd)
+        subprocess.run(cmd, env=env)
+
+
+def pick_candidates(all_screens, batch_size=100):
+    """Pick one screen from each of the least reviewed movies.
 
+    Movies are visited in order of how many of their screens are
+    rated (ties broken by folder) until `batch_size` screens are found.
+    """
     candidates = []
-    keys = [(count_rated(v), k) for k, v in all_screens.items()]
-    while keys and len(candidates) < 100:
-        keys = sorted(keys)
-        count, key = keys.pop(0)
-        movie_screens = all_screens[key]
+    heap = [(movie_screens.rated_count, k) for k, movie_screens in all_screens.items()]
+    heapq.heapify(heap)
+    while heap and len(candidates) < batch_size:
+        count, key = heapq.heappop(heap)
         try:
-            thumbnail = pick_screen(movie_screens)
+            thumbnail = pick_screen(all_screens[key])
         except NoRemainingScreens:
             continue
         candidates.append(str(thumbnail))
-    env = {k: v for k, v in os.environ.items()}
-    env['PATH'] = str(C.SCRIPTSDIR) + ':' + env['PATH']
-    cmd = ['qiv', '-CtS'] + candidates[:100]
-    print(cmd)
-    subprocess.run(cmd, env=env)
+    return candidates
+
+
+class MovieScreens:
+    """A movie's (thumbnail, rating) list plus the positions of the
+    positively rated and the unrated thumbnails."""
+
+    def __init__(self, screens):
+        self.screens = screens
+        self.positive = [i for i, s in enumerate(screens) if s[1] == 1]
+        self.unrated = [i for i, s in enumerate(screens) if s[1] is None]
+        self.rated_count = len(screens) - len(self.unrated)
 
+    def __len__(self):
+        return len(self.screens)
 
-def count_rated(screens):
-    return len([s for s in screens if s[1] is not None])
+    def __getitem__(self, i):
+        return self.screens[i]
 
 
 class NoRemainingScreens(Exception):
@@ -41,8 +81,7 @@ class NoRemainingScreens(Exception):
 
 
 def pick_screen(movie_screens):
-    positive_screens = [(i, s) for i, s in enumerate(movie_screens) if s[1] == 1]
-    for i, s in positive_screens:
+    for i in movie_screens.positive:
         if is_first_in_triple(i, movie_screens):
             continue
         if is_second_in_triple(i, movie_screens):
@@ -53,15 +92,14 @@ def pick_screen(movie_screens):
             return movie_screens[i - 1][0]
         if next_is_not_rated(i, movie_screens):
             return movie_screens[i + 1][0]
-    other_screens = [(i, s) for i, s in enumerate(movie_screens) if s[1] is None]
-    if not other_screens:
+    if not movie_screens.unrated:
         raise NoRemainingScreens()
-    random.shuffle(other_screens)
-    for i, screen in other_screens:
+    other_screens = random.sample(movie_screens.unrated, len(movie_screens.unrated))
+    for i in other_screens:
         if any_nearby_is_rated(i, movie_screens):
             continue
-        return screen[0]
-    return other_screens[0][1][0]
+        return movie_screens[i][0]
+    return movie_screens[other_screens[0]][0]
 
 
 def any_nearby_is_rated(i, movie_screens):
@@ -109,40 +147,29 @@ def offset_is_not_rated(i, movie_screens, offset):
 
 
 def get_all_screens():
-    for _, filename, metadata in util.get_file_data():
-        if not is_basic_format(metadata):
+    """Yield (base_dir, [(thumbnail path, rating), ...]) for every movie
+    in the basic format, with the thumbnails in order.
+
+    Everything comes from one query over the thumbnail table; the
+    screens folders are never listed, only checked for being finished
+    (their thumbnails are in screens-tmp/ until they are).
+    """
+    base_dirs = {row['id']: C.RAWDIR.joinpath(row['folder'])
+                 for row in util.query_movies(**BASIC_FORMAT)}
+    db = util.get_db()
+    cur = db.execute(
+        'SELECT movie_id, filename, rating FROM thumbnail ORDER BY movie_id, filename')
+    for movie_id, rows in itertools.groupby(cur, key=lambda row: row['movie_id']):
+        base_dir = base_dirs.pop(movie_id, None)
+        if base_dir is None:
             continue
-        base_dir = util.get_folder(filename)
         screens = base_dir.joinpath('screens')
-        if not screens.exists():
+        if not screens.is_dir() or not make_thumbs.is_current(make_thumbs.read_manifest(screens)):
             print('{} is missing screens!'.format(base_dir))
             continue
-        yield base_dir, list(get_single_movie_screens(screens))
-
-
-def is_basic_format(metadata):
-    if metadata['format']['orientation'] != 'sbs':
-        return False
-    if metadata['format']['fov'] != '180':
-        return False
-    if metadata['format']['perspective'] != 'normal':
-        return False
-    return True
-
-
-def get_single_movie_screens(screen_dir):
-    base_dir = util.get_folder(screen_dir)
-    db = util.get_db()
-    cur = db.execute("""
-select t.filename, t.rating
-from thumbnail t
-inner join movie m
-on t.movie_id = m.id
-where m.folder = ?""", (base_dir.name,))
-    ratings = {row['filename']: row['rating'] for row in cur}
-    for filename in sorted(screen_dir.iterdir()):
-        if filename.suffix == '.jpg':
-            yield filename, ratings.get(filename.name)
+        yield base_dir, [(screens.joinpath(row['filename']), row['rating']) for row in rows]
+    for base_dir in base_dirs.values():
+        print('{} is missing screens!'.format(base_dir))
 
 
 if __name__ == '__main__':
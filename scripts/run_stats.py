@@ -0,0 +1,89 @@
+"""Report on the timings the pipeline scripts record in run_stats"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+import util
+
+
+COLUMNS = ['run', 'script', 'stage', 'kind', 'started', 'wall', 'cpu', 'max_rss', 'read_bytes',
+           'items', 'source_seconds']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary = subparsers.add_parser(
+        'summary', help="throughput of every stage of every run")
+    summary.add_argument('--days', type=float, default=30, help="only look at the last N days")
+    summary.add_argument('--stage', help="only show this stage")
+    export = subparsers.add_parser('export', help="dump the raw rows")
+    export.add_argument('--format', choices=['csv', 'json'], default='csv')
+    export.add_argument('--days', type=float, default=None, help="only export the last N days")
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400 if args.days else 0
+    if args.command == 'summary':
+        print_summary(since, args.stage)
+    else:
+        export_rows(since, args.format)
+
+
+def export_rows(since, fmt):
+    db = util.get_db()
+    cur = db.execute(
+        'SELECT {} FROM run_stats WHERE started >= ? ORDER BY started'.format(', '.join(COLUMNS)),
+        (since,))
+    rows = [dict(row) for row in cur]
+    if fmt == 'json':
+        json.dump(rows, sys.stdout, indent=1)
+        print()
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_summary(since, stage=None):
+    """One line per (run, stage).
+
+    Subprocesses of a stage may have run in parallel, so rates are
+    worked out over the stage's elapsed time (first start to last end)
+    rather than over the sum of the individual wall times.
+    """
+    db = util.get_db()
+    cur = db.execute("""
+        SELECT run, script, stage, count(*) AS calls,
+            min(started) AS first_started,
+            max(started + wall) - min(started) AS elapsed,
+            sum(cpu) AS cpu, max(max_rss) AS max_rss, sum(read_bytes) AS read_bytes,
+            sum(items) AS items, sum(source_seconds) AS source_seconds
+        FROM run_stats
+        WHERE started >= ? AND (? IS NULL OR stage = ?)
+        GROUP BY run, stage
+        ORDER BY first_started
+    """, (since, stage, stage))
+    header = '{:16s} {:16s} {:22s} {:>6s} {:>9s} {:>9s} {:>8s} {:>9s} {:>10s} {:>10s}'
+    line = '{:16s} {:16s} {:22s} {:6d} {:9.1f} {:9.1f} {:8.0f} {:9.0f} {:>10s} {:>10s}'
+    print(header.format(
+        'started', 'script', 'stage', 'calls', 'elapsed s', 'cpu s', 'rss MB', 'read MB',
+        'items/s', 'src s/s'))
+    for row in cur:
+        elapsed = row['elapsed'] or 0
+        print(line.format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(row['first_started'])),
+            row['script'][:16], row['stage'][:22], row['calls'], elapsed, row['cpu'] or 0,
+            (row['max_rss'] or 0) / 1024, (row['read_bytes'] or 0) / 1024**2,
+            rate(row['items'], elapsed), rate(row['source_seconds'], elapsed)))
+
+
+def rate(amount, elapsed):
+    if amount is None or not elapsed:
+        return '-'
+    return '{:.1f}'.format(amount / elapsed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
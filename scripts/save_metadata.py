@@ -1,3 +1,4 @@
+import argparse
 import json
 import os
 import pathlib
@@ -5,61 +6,160 @@ import sys
 
 import yaml
 
+import catalog
 import constants as C
 import metadata as mm
 import util
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="only look at folders that are new or changed since the last run")
+    args = parser.parse_args()
+
+    db = util.get_db()
+    failed = []
+    with util.timed('save folders', items=0) as counts:
+        for dirpath in get_changed_dirs(args.incremental):
+            try:
+                save_folder(dirpath)
+            except Exception as e:
+                # one bad folder shouldn't stop the rest from being saved
+                print('*** {}: {} ***'.format(dirpath, e), file=sys.stderr)
+                failed.append(dirpath)
+                continue
+            counts['items'] += 1
+    db.commit()
+    if failed:
+        print('{} folders could not be saved'.format(len(failed)), file=sys.stderr)
+        return 1
+
+
+def get_changed_dirs(incremental=False):
+    """Return the movie folders to save: all of them, or with
+    `incremental` only the ones that are new or changed.
+
+    Also forgets the folder_state of folders that are gone and reports
+    movies whose folder has been removed.
+    """
+    db = util.get_db()
+    states = get_folder_states()
+    seen = set()
+    changed = []
+    for dirpath in get_movie_dirs():
+        seen.add(dirpath.name)
+        if incremental and is_unchanged(dirpath, states.get(dirpath.name)):
+            continue
+        changed.append(dirpath)
+    db.executemany('DELETE FROM folder_state WHERE folder = ?',
+                   [(folder,) for folder in set(states) - seen])
+    db.commit()
+    for row in db.execute('SELECT folder FROM movie ORDER BY folder'):
+        if row['folder'] not in seen:
+            print('*** {} has been removed from {} ***'.format(row['folder'], C.RAWDIR))
+    return changed
+
+
+def save_folder(dirpath):
+    """Save the metadata of the movie in `dirpath`; returns its id."""
     db = util.get_db()
     cur = db.cursor()
-    for moviefile in get_movie_files():
-        print(moviefile)
-        base_dir = util.get_folder(moviefile)
-        metadata = mm.get_override_metadata(base_dir)
-        if 'video' not in metadata:
-            metadata['video'] = mm.get_stats(moviefile)
-        if 'format' not in metadata:
-            metadata['format'] = mm.get_format(moviefile)
-        if not mm.is_valid_format(metadata['format']):
-            raise Exception(
-                '{} does not a valid format: {}'.format(moviefile, metadata['format']))
-        if mm.needs_actress(metadata):
-            mm.populate_actress(moviefile, metadata)
-        if mm.needs_studio(metadata):
-            mm.populate_studio(moviefile, metadata)
-        if mm.needs_title(metadata):
-            mm.populate_title(moviefile, metadata)
-        filename = moviefile.relative_to(base_dir)
-        cur.execute('SELECT id FROM movie WHERE filename = ?', (str(filename),))
-        # TODO: ensure only 0 or 1 response
-        row = cur.fetchone()
-        folder = base_dir.name
-        if row:
-            cur.execute(
-                'UPDATE movie SET folder = ?, metadata = ? WHERE id=?',
-                (folder, json.dumps(metadata), row['id']))
+    metadata = mm.get_override_metadata(dirpath)
+    moviefile = get_movie_file(dirpath, metadata)
+    print(moviefile)
+    base_dir = catalog.get_folder(moviefile)
+    if 'video' not in metadata:
+        metadata['video'] = mm.get_stats(moviefile)
+    if 'format' not in metadata:
+        metadata['format'] = mm.get_format(moviefile)
+    if not mm.is_valid_format(metadata['format']):
+        raise Exception(
+            '{} does not a valid format: {}'.format(moviefile, metadata['format']))
+    if mm.needs_actress(metadata):
+        mm.populate_actress(moviefile, metadata)
+    if mm.needs_studio(metadata):
+        mm.populate_studio(moviefile, metadata)
+    if mm.needs_title(metadata):
+        mm.populate_title(moviefile, metadata)
+    filename = moviefile.relative_to(base_dir)
+    cur.execute('SELECT id FROM movie WHERE filename = ?', (str(filename),))
+    # TODO: ensure only 0 or 1 response
+    row = cur.fetchone()
+    folder = base_dir.name
+    if row:
+        movie_id = row['id']
+        cur.execute(
+            'UPDATE movie SET folder = ?, metadata = ? WHERE id=?',
+            (folder, json.dumps(metadata), movie_id))
+    else:
+        # don't need to save the file data as that is in a column by itself
+        metadata.pop('file', None)
+        cur.execute(
+            'INSERT INTO movie (folder, filename, metadata) VALUES (?, ?, ?)',
+            (folder, str(filename), json.dumps(metadata)))
+        movie_id = cur.lastrowid
+    catalog.get_catalog().add(movie_id, folder, filename, metadata)
+    # fingerprint last, saving metadata.yaml above can change its mtime
+    cur.execute(
+        'INSERT OR REPLACE INTO folder_state (folder, filename, fingerprint) VALUES (?, ?, ?)',
+        (folder, str(filename), get_fingerprint(dirpath, filename)))
+    return movie_id
+
+
+# what make_thumbs writes into a movie folder
+SCREENS_DIRS = {'screens', 'screens-tmp', 'screens-review'}
+
+
+def get_folder_states():
+    db = util.get_db()
+    cur = db.execute('SELECT folder, filename, fingerprint FROM folder_state')
+    return {row['folder']: row for row in cur}
+
+
+def is_unchanged(dirpath, state):
+    """Whether a folder is the same as when its folder_state was saved."""
+    return state is not None and state['fingerprint'] == get_fingerprint(
+        dirpath, state['filename'])
+
+
+def get_fingerprint(dirpath, filename):
+    """Summarize everything about a folder that save_folder depends on.
+
+    That is what is in the folder (files added or removed), the
+    metadata.yaml mtime and the size and mtime of the movie file.
+    """
+    # the folder's names rather than its mtime, which changes whenever
+    # make_thumbs creates or renames screens
+    parts = [sorted(name for name in os.listdir(str(dirpath)) if name not in SCREENS_DIRS)]
+    for path in (dirpath.joinpath('metadata.yaml'), dirpath.joinpath(filename)):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            parts.append(None)
         else:
-            # don't need to save the file data as that is in a column by itself
-            metadata.pop('file', None)
-            cur.execute(
-                'INSERT INTO movie (folder, filename, metadata) VALUES (?, ?, ?)',
-                (folder, str(filename), json.dumps(metadata)))
-    db.commit()
+            parts.append([stat.st_size, stat.st_mtime_ns])
+    return json.dumps(parts)
 
 
-def get_movie_files():
+def get_movie_dirs():
     for dirpath in C.RAWDIR.iterdir():
-        if not dirpath.is_dir():
-            continue
+        if dirpath.is_dir():
+            yield dirpath
+
+
+def get_movie_files():
+    for dirpath in get_movie_dirs():
         mf = get_movie_file(dirpath)
         if not mf:
             raise Exception('No movie in {}'.format(dirpath))
         yield mf
 
 
-def get_movie_file(dirpath):
-    metadata = mm.get_override_metadata(dirpath)
+def get_movie_file(dirpath, metadata=None):
+    if metadata is None:
+        metadata = mm.get_override_metadata(dirpath)
     if 'file' in metadata:
         path = pathlib.Path(metadata['file'])
         if path.is_absolute():
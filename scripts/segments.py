@@ -0,0 +1,141 @@
+"""Cut clips out of movies one at a time and join them with the concat demuxer
+
+Seeking on the input side (-ss/-t before -i) means ffmpeg only decodes
+from the keyframe before each clip, so the work depends on the length
+of the output and not on where in the sources the clips are. The clips
+are kept in a cache so rendering a compilation again at the same
+resolution only has to run the concat step.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import constants as C
+import util
+
+
+# rendered clips, named by a hash of the slice and the encoder settings
+CACHE_DIR = C.DATADIR.joinpath('clip-cache')
+CACHE_SIZE = 20 * 1024**3
+
+
+# every clip and group gets the same frame rate and audio layout, so
+# the concat demuxer can join them without re-encoding even when the
+# sources differ (44.1 and 48 kHz, mono, 29.97 and 60 fps, ...)
+ENCODE_ARGS = [
+    '-c:v', 'libx264', '-crf', '21', '-profile:v', 'baseline', '-level', '3.0', '-r', '30',
+    '-c:a', 'aac', '-b:a', '160k', '-ar', '48000', '-ac', '2',
+]
+
+
+def scale_filter(target_resolution):
+    return "{w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2".format(
+        w=int(target_resolution[0]), h=int(target_resolution[1]))
+
+
+def segment_cmd(movie_file, time_slice, target_resolution, output, copy=False):
+    start, end = time_slice
+    cmd = ['ffmpeg', '-y', '-ss', str(start), '-t', str(end - start), '-i', str(movie_file),
+           '-map', '0:v:0', '-map', '0:a:0']
+    if copy:
+        # the cut starts at the keyframe before `start`
+        return cmd + ['-c', 'copy', '-avoid_negative_ts', 'make_zero', str(output)]
+    return cmd + ['-vf', 'scale=' + scale_filter(target_resolution)] + ENCODE_ARGS + [str(output)]
+
+
+def concat_cmd(segment_files, list_file, output):
+    with open(list_file, 'w') as fout:
+        for segment in segment_files:
+            fout.write("file '{}'\n".format(str(pathlib.Path(segment).resolve()).replace("'", "'\\''")))
+    return ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', str(list_file), '-c', 'copy', str(output)]
+
+
+def render(clips, target_resolution, output, copy=False, workers=1, cache_size=CACHE_SIZE):
+    """Cut `clips`, a list of (movie_id, movie file, time slice), into
+    the clip cache on `workers` ffmpeg processes and then join them into
+    `output`."""
+    output = pathlib.Path(output)
+    settings = ['copy'] if copy else [scale_filter(target_resolution)] + ENCODE_ARGS
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cached = [cache_path(movie_id, movie_file, time_slice, settings)
+              for movie_id, movie_file, time_slice in clips]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for (_, movie_file, time_slice), path in zip(clips, cached):
+            if path.exists():
+                print('using cached {}'.format(path))
+                continue
+            futures.append(executor.submit(
+                render_segment, movie_file, time_slice, target_resolution, path, copy))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    for path in cached:
+        # mtime is the "last used" time for the LRU eviction
+        os.utime(str(path))
+    with tempfile.TemporaryDirectory(prefix='segments-', dir=str(output.parent)) as tmp:
+        cmd = concat_cmd(cached, pathlib.Path(tmp).joinpath('segments.txt'), output)
+        print(cmd)
+        p = util.run(cmd, check=True, stage='concat segments', items=len(cached))
+        print('concat: peak RSS {:.0f} MB'.format(p.rusage.ru_maxrss / 1024))
+    evict(cache_size)
+
+
+def render_segment(movie_file, time_slice, target_resolution, path, copy):
+    # write next to the final name and rename, so an interrupted
+    # render never leaves a broken clip in the cache
+    tmp = path.with_name('tmp-{}-{}'.format(os.getpid(), path.name))
+    cmd = segment_cmd(movie_file, time_slice, target_resolution, tmp, copy)
+    print(cmd)
+    try:
+        p = util.run(cmd, check=True, stage='render segment', items=1,
+                     source_seconds=time_slice[1] - time_slice[0])
+        print('{}: peak RSS {:.0f} MB'.format(path.name, p.rusage.ru_maxrss / 1024))
+        os.replace(str(tmp), str(path))
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def cache_path(movie_id, movie_file, time_slice, settings):
+    # the source's size and mtime are in there too so replacing a
+    # movie's file doesn't serve clips of the old one
+    stat = os.stat(str(movie_file))
+    key = json.dumps([movie_id, stat.st_size, stat.st_mtime_ns, list(time_slice), settings])
+    return CACHE_DIR.joinpath(hashlib.sha1(key.encode('utf-8')).hexdigest() + '.mp4')
+
+
+def evict(cache_size):
+    """Delete the least recently used clips until the cache is no bigger
+    than `cache_size` bytes."""
+    clips = []
+    for path in CACHE_DIR.glob('*.mp4'):
+        if path.name.startswith('tmp-'):
+            continue
+        stat = path.stat()
+        clips.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in clips)
+    for _, size, path in sorted(clips):
+        if total <= cache_size:
+            break
+        print('evicting {} from the clip cache'.format(path))
+        path.unlink()
+        total -= size
+
+
+def codec_parameters(movie_file):
+    """The stream parameters that have to match for clips to be joined
+    without re-encoding."""
+    streams = util.probe(movie_file)['streams']
+    video = next(s for s in streams if s['codec_type'] == 'video')
+    audio = next((s for s in streams if s['codec_type'] == 'audio'), {})
+    return (
+        video.get('codec_name'), video.get('profile'), video.get('width'), video.get('height'),
+        video.get('pix_fmt'), video.get('r_frame_rate'), video.get('time_base'),
+        audio.get('codec_name'), audio.get('sample_rate'), audio.get('channels'))
+
+
+def can_stream_copy(movie_files):
+    return len({codec_parameters(f) for f in movie_files}) <= 1
@@ -0,0 +1,40 @@
+import random
+import unittest
+
+import intervals
+import multi_movie_cuts
+
+
+def random_slice(rand, duration, max_length=45):
+    start = rand.uniform(0, duration)
+    return (start, min(duration, start + rand.uniform(0, max_length)))
+
+
+class IntervalIndexTest(unittest.TestCase):
+
+    def test_matches_has_overlap(self):
+        # random data, including touching endpoints, zero length slices
+        # and slices that are added after the index was built
+        rand = random.Random(0)
+        for _ in range(2000):
+            duration = rand.choice([60, 600])
+            existing = [random_slice(rand, duration) for _ in range(rand.randint(0, 20))]
+            # integer endpoints make touching intervals common
+            existing += [(float(a), float(a + rand.randint(0, 30)))
+                         for a in rand.sample(range(duration), rand.randint(0, 5))]
+            index = intervals.IntervalIndex(existing[:len(existing) // 2])
+            for start, end in existing[len(existing) // 2:]:
+                index.add(start, end)
+            for _ in range(20):
+                candidate = rand.choice([
+                    random_slice(rand, duration),
+                    (float(rand.randint(0, duration)),) * 2,
+                    tuple(sorted(float(rand.randint(0, duration)) for _ in range(2))),
+                ])
+                self.assertEqual(
+                    index.overlaps(candidate),
+                    multi_movie_cuts.has_overlap(candidate, existing), (candidate, existing))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import subprocess
+import unittest
+from unittest import mock
+
+import keyframes
+
+
+class ParseKeyframesTest(unittest.TestCase):
+
+    def test_keyframes_only(self):
+        output = '0.000000,K__\n0.033367,___\n2.002000,K__\nN/A,K__\n'
+        self.assertEqual(keyframes.parse_keyframes(output), [0.0, 2.002])
+
+    def test_offset_start(self):
+        # MPEG-TS streams usually start at 1.4s or so
+        output = '1.400000,K__\n3.400000,K_\n1.433367,___\n5.400000,K__\n'
+        self.assertEqual(
+            [round(t, 6) for t in keyframes.parse_keyframes(output, start_time=1.4)],
+            [0.0, 2.0, 4.0])
+
+    def test_presentation_order(self):
+        output = '4.000000,K__\n2.000000,K__\n'
+        self.assertEqual(keyframes.parse_keyframes(output), [2.0, 4.0])
+
+
+class GetKeyframesTest(unittest.TestCase):
+
+    def test_counts_from_the_file_start(self):
+        # the audio starts first, so -ss 0 is at 1.4s and not at the video's 1.5s
+        probe = {
+            'format': {'start_time': '1.400000'},
+            'streams': [
+                {'codec_type': 'audio', 'start_time': '1.400000'},
+                {'codec_type': 'video', 'start_time': '1.500000', 'time_base': '1/90000'},
+            ],
+        }
+        output = b'1.500000,K__\n3.500000,K__\n'
+        with mock.patch('util.probe', return_value=probe), mock.patch(
+                'util.run', return_value=subprocess.CompletedProcess([], 0, output, None)):
+            self.assertEqual(
+                [round(t, 6) for t in keyframes.get_keyframes('movie.mp4')], [0.1, 2.1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import pathlib
+import random
+import tempfile
+import unittest
+
+import constants as C
+import make_thumbs
+import multi_movie_cuts
+import util
+
+
+class UsedCutsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = util._db, util._db_thread
+        util._db = util.connect(pathlib.Path(self.tmp.name).joinpath('data.db'))
+        util._db.executemany(
+            'INSERT INTO movie (id, folder, filename, metadata) VALUES (?, ?, ?, ?)',
+            [(1, 'amy.x-one', 'one.mp4', '{}'), (2, 'jane.doe-two', 'two.mp4', '{}')])
+        util._db.commit()
+        # (normalized position, time slice, movie_id), as get_timestamps makes them
+        self.timestamps = [(0.6, [10.5, 40.25], 2), (0.75, [100.0, 130.0], 1)]
+        multi_movie_cuts.save_used_cuts('collage/collage-test.mp4', self.timestamps)
+
+    def tearDown(self):
+        util._db.close()
+        util._db, util._db_thread = self.saved
+        self.tmp.cleanup()
+
+    def test_replay(self):
+        clips = multi_movie_cuts.get_saved_clips('collage/collage-test.mp4')
+        self.assertEqual(clips, [
+            (2, C.RAWDIR.joinpath('jane.doe-two', 'two.mp4'), (10.5, 40.25)),
+            (1, C.RAWDIR.joinpath('amy.x-one', 'one.mp4'), (100.0, 130.0)),
+        ])
+        # found by its file name too
+        self.assertEqual(multi_movie_cuts.get_saved_clips('/elsewhere/collage-test.mp4'), clips)
+
+    def test_used_cuts_exclude_saved_cuts(self):
+        used = multi_movie_cuts.get_used_cuts()
+        self.assertTrue(used[2].overlaps((20.0, 50.0)))
+        self.assertTrue(used[1].overlaps((90.0, 100.0)))
+        self.assertFalse(used[1].overlaps((20.0, 50.0)))
+        self.assertFalse(used[3].overlaps((0.0, 1000.0)))
+        # a thumbnail inside movie 2's saved cut can't be used again
+        picked = list(multi_movie_cuts.get_timestamps(
+            [(2, 25.0), (1, 500.0)], {1: 1000.0, 2: 1000.0}, used, 1000))
+        self.assertEqual([movie_id for _, _, movie_id in picked], [1])
+
+    def test_migration_drops_positions_saved_as_movie_ids(self):
+        db = util.connect(pathlib.Path(self.tmp.name).joinpath('old.db'), version=11)
+        db.executemany(
+            'INSERT INTO used_cuts (collage, movie_id, start, end) VALUES (?, ?, ?, ?)',
+            [('c.mp4', 0.6, 1.0, 2.0), ('c.mp4', 0, 1.0, 2.0), ('c.mp4', 3, 1.0, 2.0)])
+        db.commit()
+        util.migrate(db)
+        self.assertEqual([row['movie_id'] for row in db.execute('SELECT movie_id FROM used_cuts')],
+                         [3])
+        db.close()
+
+
+class GoodThumbsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = util._db, util._db_thread
+        util._db = util.connect(pathlib.Path(self.tmp.name).joinpath('data.db'))
+        rand = random.Random(0)
+        util._db.executemany(
+            'INSERT INTO thumbnail (movie_id, filename, rating, ts) VALUES (?, ?, ?, ?)',
+            [(movie_id, make_thumbs.thumb_name(i), rand.choice([None, 0, 1, 1]),
+              i * C.SCREENSHOT_FREQUENCY + C.SCREENSHOT_START)
+             for movie_id in range(1, 21) for i in range(60)])
+        util._db.commit()
+
+    def tearDown(self):
+        util._db.close()
+        util._db, util._db_thread = self.saved
+        self.tmp.cleanup()
+
+    def test_methods_agree(self):
+        methods = ['python', 'sql'] + (['numpy'] if multi_movie_cuts.np is not None else [])
+        for n in (1, 2):
+            expected = sorted(multi_movie_cuts.get_all_good_thumbs(n, method='python'))
+            self.assertTrue(expected)
+            for method in methods:
+                with self.subTest(method=method, n=n):
+                    self.assertEqual(
+                        sorted(multi_movie_cuts.get_all_good_thumbs(n, method=method)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
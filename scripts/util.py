@@ -1,8 +1,15 @@
+import asyncio
+import atexit
+import contextlib
 import json
 import os
 import pathlib
+import resource
 import sqlite3
 import subprocess
+import sys
+import threading
+import time
 
 import constants as C
 
@@ -18,30 +25,234 @@ def to_json(byts):
     return json.loads(byts.decode('utf-8'))
 
 
+# Each entry upgrades the schema by one version; the version a database
+# is at is kept in PRAGMA user_version. Only ever append to this list.
+MIGRATIONS = [
+    # 1: the original tables
+    [
+        "CREATE TABLE IF NOT EXISTS movie "
+        "(id INTEGER PRIMARY KEY, folder TEXT, filename TEXT, metadata JSON)",
+        "CREATE TABLE IF NOT EXISTS thumbnail "
+        "(id INTEGER PRIMARY KEY, movie_id INTEGER, filename TEXT, rating INT,"
+        "FOREIGN KEY(movie_id) REFERENCES movie(id))",
+        "CREATE TABLE IF NOT EXISTS used_cuts "
+        "(id INTEGER PRIMARY KEY, collage TEXT, movie_id INTEGER, start FLOAT, end FLOAT,"
+        "FOREIGN KEY(movie_id) REFERENCES movie(id))",
+    ],
+    # 2: ffprobe cache and save_metadata --incremental bookkeeping
+    [
+        "CREATE TABLE IF NOT EXISTS probe_cache "
+        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, probe JSON)",
+        "CREATE TABLE IF NOT EXISTS folder_state "
+        "(folder TEXT PRIMARY KEY, filename TEXT, fingerprint TEXT)",
+    ],
+    # 3: indexes for the lookups every script does. Duplicate thumbnail
+    #    rows have to go before the unique index can be built; keep the
+    #    rated one if there is one, otherwise the newest.
+    [
+        "DELETE FROM thumbnail WHERE id NOT IN ("
+        " SELECT id FROM ("
+        "  SELECT id, ROW_NUMBER() OVER ("
+        "   PARTITION BY movie_id, filename ORDER BY rating IS NULL, id DESC) AS n"
+        "  FROM thumbnail)"
+        " WHERE n = 1)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS thumbnail_movie_filename "
+        "ON thumbnail (movie_id, filename)",
+        "CREATE INDEX IF NOT EXISTS movie_folder ON movie (folder)",
+        "CREATE INDEX IF NOT EXISTS movie_filename ON movie (filename)",
+        "CREATE INDEX IF NOT EXISTS used_cuts_movie ON used_cuts (movie_id)",
+    ],
+    # 4: the liked thumbnails are all multi_movie_cuts looks at
+    [
+        "CREATE INDEX IF NOT EXISTS thumbnail_positive "
+        "ON thumbnail (movie_id, filename) WHERE rating = 1",
+    ],
+    # 5: timings recorded by util.run and util.timed
+    [
+        "CREATE TABLE IF NOT EXISTS run_stats "
+        "(id INTEGER PRIMARY KEY, run TEXT, script TEXT, stage TEXT, kind TEXT,"
+        " started FLOAT, wall FLOAT, cpu FLOAT, max_rss INTEGER, read_bytes INTEGER,"
+        " items INTEGER, source_seconds FLOAT)",
+        "CREATE INDEX IF NOT EXISTS run_stats_started ON run_stats (started)",
+    ],
+    # 6: where a thumbnail really is, for ones that aren't exactly on
+    #    the SCREENSHOT_START/SCREENSHOT_FREQUENCY grid (keyframe mode)
+    [
+        "ALTER TABLE thumbnail ADD COLUMN ts FLOAT",
+    ],
+    # 7: every thumbnail gets its ts, so nothing has to work it out from
+    #    the filename, and the pts of the frame in the video stream's
+    #    time base (NULL for thumbnails made before it was recorded)
+    [
+        "ALTER TABLE thumbnail ADD COLUMN pts INTEGER",
+        "UPDATE thumbnail "
+        "SET ts = cast(substr(filename, 6, length(filename) - 9) as integer) * {} + {} "
+        "WHERE ts IS NULL AND filename GLOB 'thumb[0-9]*.jpg'".format(
+            C.SCREENSHOT_FREQUENCY, C.SCREENSHOT_START),
+        "DROP INDEX IF EXISTS thumbnail_positive",
+        "CREATE INDEX thumbnail_positive "
+        "ON thumbnail (movie_id, filename, ts) WHERE rating = 1",
+    ],
+    # 8: the metadata fields movies get filtered and sorted on, as
+    #    columns so that doesn't mean decoding every row's JSON
+    [
+        "ALTER TABLE movie ADD COLUMN {} GENERATED ALWAYS AS "
+        "(json_extract(metadata, '{}')) VIRTUAL".format(column, path)
+        for column, path in [
+            ('fov TEXT', '$.format.fov'),
+            ('orientation TEXT', '$.format.orientation'),
+            ('perspective TEXT', '$.format.perspective'),
+            ('duration FLOAT', '$.video.duration'),
+            ('width INTEGER', '$.video.width'),
+            ('height INTEGER', '$.video.height'),
+            ('studio TEXT', '$.studio'),
+        ]
+    ] + [
+        "CREATE INDEX IF NOT EXISTS movie_format ON movie (orientation, fov, perspective)",
+        "CREATE INDEX IF NOT EXISTS movie_duration ON movie (duration)",
+        "CREATE INDEX IF NOT EXISTS movie_size ON movie (width, height)",
+        "CREATE INDEX IF NOT EXISTS movie_studio ON movie (studio)",
+    ],
+    # 9: where a thumbnail is in its movie's screens.pack (see packs.py)
+    [
+        "ALTER TABLE thumbnail ADD COLUMN pack_offset INTEGER",
+        "ALTER TABLE thumbnail ADD COLUMN pack_length INTEGER",
+    ],
+    # 10: keyframe and scene change times of each movie (see keyframes.py)
+    [
+        "CREATE TABLE IF NOT EXISTS movie_index "
+        "(movie_id INTEGER PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+        "keyframes BLOB, scenes BLOB, scene_scores BLOB, scene_threshold FLOAT)",
+    ],
+    # 11: keyframes used to be indexed on the stream's clock rather than
+    #     from its start_time, so index again
+    [
+        "DELETE FROM movie_index",
+    ],
+    # 12: multi_movie_cuts used to save each cut's position in the
+    #     compilation (0..1) as its movie_id; those rows point nowhere
+    [
+        "DELETE FROM used_cuts WHERE typeof(movie_id) != 'integer' OR movie_id = 0",
+    ],
+    # 13: keyframes were then counted from the video stream's start_time,
+    #     but -ss counts from the file's, so index again
+    [
+        "DELETE FROM movie_index",
+    ],
+]
+
+# the movie columns that come from its metadata (see migration 8)
+MOVIE_COLUMNS = ('fov', 'orientation', 'perspective', 'duration', 'width', 'height', 'studio')
+
+
+def connect(db_path, version=None, timeout=5.0):
+    """Open a database and bring its schema up to `version` (default: latest).
+
+    `timeout` is how many seconds to wait for another writer's lock.
+    """
+    sqlite3.register_converter("JSON", to_json)
+    db = sqlite3.connect(str(db_path), timeout=timeout, detect_types=sqlite3.PARSE_DECLTYPES)
+    db.row_factory = sqlite3.Row
+    # WAL lets qiv-command record ratings while make_thumbs is writing
+    db.execute('PRAGMA journal_mode=WAL')
+    migrate(db, version)
+    return db
+
+
+def migrate(db, version=None):
+    if version is None:
+        version = len(MIGRATIONS)
+    current = db.execute('PRAGMA user_version').fetchone()[0]
+    for i in range(current, version):
+        print('*** migrating database to version {} ***'.format(i + 1))
+        with db:
+            # sqlite3 only starts transactions for DML by itself; without
+            # this the ALTERs of a failed migration would stay applied
+            # while user_version didn't move
+            db.execute('BEGIN')
+            for statement in MIGRATIONS[i]:
+                db.execute(statement)
+            db.execute('PRAGMA user_version = {:d}'.format(i + 1))
+
+
 _db = None
+# the thread get_db's connection belongs to
+_db_thread = None
 def get_db() -> sqlite3.Connection:
-    global _db
+    global _db, _db_thread
     if not _db:
-        sqlite3.register_converter("JSON", to_json)
-        db_path = C.DATADIR.joinpath('data.db')
-        _db = sqlite3.connect(str(db_path), detect_types=sqlite3.PARSE_DECLTYPES)
-        _db.row_factory = sqlite3.Row
-        c = _db.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS movie "
-                  "(id INTEGER PRIMARY KEY, folder TEXT, filename TEXT, metadata JSON)")
-        c.execute("CREATE TABLE IF NOT EXISTS thumbnail "
-                  "(id INTEGER PRIMARY KEY, movie_id INTEGER, filename TEXT, rating INT,"
-                  "FOREIGN KEY(movie_id) REFERENCES movie(id))")
-        c.execute("CREATE TABLE IF NOT EXISTS used_cuts "
-                  "(id INTEGER PRIMARY KEY, collage TEXT, movie_id INTEGER, start FLOAT, end FLOAT,"
-                  "FOREIGN KEY(movie_id) REFERENCES movie(id))")
+        _db = connect(C.DATADIR.joinpath('data.db'))
+        _db_thread = threading.get_ident()
     return _db
 
 
-def get_file_data():
+@contextlib.contextmanager
+def transaction(db=None):
+    """Run the with block as one write transaction.
+
+    BEGIN IMMEDIATE takes the write lock up front, so a batch either
+    waits for other writers before it starts or is committed as a
+    whole; it is rolled back if the block raises.
+    """
+    db = db or get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+def query_movies(order_by='id', metadata=False, **where):
+    """Yield the movie rows whose metadata columns match `where`.
+
+    Each keyword is one of MOVIE_COLUMNS, with either a value or a
+    list of allowed values, e.g. query_movies(fov='180',
+    orientation=['sbs', 'ab']). Rows have the id, folder, filename and
+    MOVIE_COLUMNS of the movie; the metadata JSON is only read and
+    decoded if `metadata` is set.
+    """
+    columns = ['id', 'folder', 'filename'] + list(MOVIE_COLUMNS)
+    if metadata:
+        columns.append('metadata')
+    clauses = []
+    params = []
+    for column, value in sorted(where.items()):
+        if column not in MOVIE_COLUMNS:
+            raise ValueError('{} is not one of the movie columns'.format(column))
+        if isinstance(value, (list, tuple, set)):
+            clauses.append('{} IN ({})'.format(column, ', '.join('?' * len(value))))
+            params.extend(value)
+        else:
+            clauses.append('{} = ?'.format(column))
+            params.append(value)
+    if order_by not in columns:
+        raise ValueError('cannot order movies by {}'.format(order_by))
+    sql = 'SELECT {} FROM movie'.format(', '.join(columns))
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY ' + order_by
+    yield from get_db().execute(sql, params)
+
+
+def movie_path(row):
+    """The movie file of a row from the movie table."""
+    return C.RAWDIR.joinpath(row['folder'], row['filename'])
+
+
+def get_movie(movie_id):
+    """Return (movie file, metadata) for one movie."""
     db = get_db()
-    for row in db.execute('SELECT id, folder, filename, metadata FROM movie'):
-        yield row['id'], C.RAWDIR.joinpath(row['folder'], row['filename']), row['metadata']
+    row = db.execute(
+        'SELECT folder, filename, metadata FROM movie WHERE id = ?', (movie_id,)).fetchone()
+    return C.RAWDIR.joinpath(row['folder'], row['filename']), row['metadata']
+
+
+def thumb_timestamp(filename):
+    """Where on the screenshot grid thumbNNNN.jpg was taken."""
+    number = int(os.path.basename(filename)[len('thumb'):-len('.jpg')])
+    return number * C.SCREENSHOT_FREQUENCY + C.SCREENSHOT_START
 
 
 def is_movie_filename(filename):
@@ -49,30 +260,223 @@ def is_movie_filename(filename):
     return ext.lower() in valid_mov_ext
 
 
+def run(cmd, check=False, stage=None, items=None, source_seconds=None, capture=False,
+        capture_stderr=False):
+    """Run `cmd` like subprocess.run and record what it cost in run_stats.
+
+    The returned CompletedProcess also carries the child's resource
+    usage as `.rusage`. `items` (thumbnails, clips, ...) and
+    `source_seconds` (seconds of movie processed) are stored along with
+    it so throughput can be worked out later.
+
+    Only one of `capture` (stdout) and `capture_stderr` can be set, as
+    the pipe is read to the end before the other one would be.
+    """
+    assert not (capture and capture_stderr)
+    started = time.time()
+    start = time.perf_counter()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE if capture else None,
+                         stderr=subprocess.PIPE if capture_stderr else None)
+    stdout = p.stdout.read() if capture else None
+    stderr = p.stderr.read() if capture_stderr else None
+    # wait4 rather than p.wait() so we get the child's rusage
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    record_stat(
+        stage or os.path.basename(cmd[0]), 'subprocess', started, time.perf_counter() - start,
+        rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss, rusage.ru_inblock * 512,
+        items, source_seconds)
+    if check and p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd, stdout, stderr)
+    completed = subprocess.CompletedProcess(cmd, p.returncode, stdout, stderr)
+    completed.rusage = rusage
+    return completed
+
+
+async def run_async(cmd, check=False, stage=None, items=None, source_seconds=None,
+                    capture=False, capture_stderr=False):
+    """run() for asyncio code: the same, minus the resource usage.
+
+    asyncio reaps the child itself, so only the wall time ends up in
+    run_stats (cpu, max_rss and read_bytes are NULL).
+    """
+    started = time.time()
+    start = time.perf_counter()
+    p = await asyncio.create_subprocess_exec(
+        *[str(c) for c in cmd], stdout=subprocess.PIPE if capture else None,
+        stderr=subprocess.PIPE if capture_stderr else None)
+    try:
+        stdout, stderr = await p.communicate()
+    except asyncio.CancelledError:
+        p.kill()
+        await p.wait()
+        raise
+    record_stat(
+        stage or os.path.basename(cmd[0]), 'subprocess', started, time.perf_counter() - start,
+        None, None, None, items, source_seconds)
+    if check and p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, p.returncode, stdout, stderr)
+
+
+@contextlib.contextmanager
+def timed(stage, items=None, source_seconds=None):
+    """Record the wall time, CPU time, peak memory and bytes read of the
+    code in the with block as a run_stats row.
+
+    The peak memory (max_rss) is the process's peak so far, not just
+    the block's: the kernel only keeps a high-water mark.
+
+    Yields a dict; set its 'items' or 'source_seconds' if they are only
+    known at the end.
+    """
+    counts = {'items': items, 'source_seconds': source_seconds}
+    started = time.time()
+    start = time.perf_counter()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    read_before = read_bytes()
+    try:
+        yield counts
+    finally:
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        record_stat(
+            stage, 'phase', started, time.perf_counter() - start,
+            (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+            after.ru_maxrss, read_bytes() - read_before,
+            counts['items'], counts['source_seconds'])
+
+
+def read_bytes():
+    """Bytes this process has read from storage so far."""
+    try:
+        with open('/proc/self/io') as fin:
+            for line in fin:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_inblock * 512
+
+
+# One id per script invocation so a run's rows can be grouped together
+RUN_ID = '{}-{}-{}'.format(
+    os.path.basename(sys.argv[0]) or 'python', time.strftime('%Y%m%d%H%M%S'), os.getpid())
+_stats = []
+_stats_lock = threading.Lock()
+_stats_flushed = time.monotonic()
+# buffered rows are written once there are this many, or they are this old
+STATS_FLUSH_SIZE = 500
+STATS_FLUSH_INTERVAL = 60
+
+
+def record_stat(stage, kind, started, wall, cpu, max_rss, bytes_read, items, source_seconds):
+    # worker threads can't use the db connection, so rows are buffered
+    # here and written by flush_stats from the connection's own thread,
+    # every so often and at exit
+    with _stats_lock:
+        _stats.append((
+            RUN_ID, os.path.basename(sys.argv[0]), stage, kind, started, wall, cpu,
+            max_rss, bytes_read, items, source_seconds))
+        due = (len(_stats) >= STATS_FLUSH_SIZE or
+               time.monotonic() - _stats_flushed >= STATS_FLUSH_INTERVAL)
+    if due and _owns_db() and not (_db and _db.in_transaction):
+        # (not in the middle of someone else's transaction, which
+        # committing the rows would end early)
+        flush_stats()
+
+
+def _owns_db():
+    if _db is None:
+        return threading.current_thread() is threading.main_thread()
+    return _db_thread == threading.get_ident()
+
+
+def flush_stats():
+    global _stats_flushed
+    with _stats_lock:
+        rows = list(_stats)
+        del _stats[:]
+        _stats_flushed = time.monotonic()
+    if not rows:
+        return
+    db = get_db()
+    db.executemany(
+        'INSERT INTO run_stats (run, script, stage, kind, started, wall, cpu, max_rss,'
+        ' read_bytes, items, source_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+
+
+atexit.register(flush_stats)
+
+
 def get_duration(filename, codec_type='video'):
-    cmd = [
-        'ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,duration',
-        '-print_format', 'json', filename
-    ]
-    output = json.loads(subprocess.check_output(cmd).decode('utf-8'))
-    for stream in output['streams']:
+    for stream in probe(filename)['streams']:
         if stream['codec_type'] == codec_type:
             return float(stream['duration'])
     raise Exception('Unable to parse the video duration')
 
 
-def get_folder(filename):
-    parent = filename.parent
-    while True:
-        if parent.parent == C.RAWDIR:
-            return parent
-        parent = parent.parent
-        if parent == pathlib.Path('/'):
-            raise Exception('No valid folder found for {}'.format(filename))
+def ffprobe_cmd(filename):
+    return [
+        'ffprobe', '-v', 'error', '-show_streams', '-show_format',
+        '-print_format', 'json', str(filename)
+    ]
+
+
+def probe(filename, refresh=False):
+    """Return the full ffprobe output (streams and format) for a file.
+
+    Results are cached in the probe_cache table and reused for as long
+    as the file's size, mtime and inode stay the same.
+    """
+    path = pathlib.Path(filename).resolve()
+    stat = path.stat()
+    if not refresh:
+        cached = get_cached_probe(path, stat)
+        if cached is not None:
+            return cached
+    # a truncated or unreadable file makes ffprobe print {} and fail
+    p = run(ffprobe_cmd(path), check=True, stage='ffprobe', items=1, capture=True)
+    try:
+        output = json.loads(p.stdout.decode('utf-8'))
+    except json.decoder.JSONDecodeError:
+        print(p.stdout.decode('utf-8'))
+        raise
+    save_probe(path, stat, output)
+    return output
+
+
+async def probe_async(filename):
+    """probe() for asyncio code; ffprobe runs without blocking the loop."""
+    path = pathlib.Path(filename).resolve()
+    stat = path.stat()
+    cached = get_cached_probe(path, stat)
+    if cached is not None:
+        return cached
+    p = await run_async(ffprobe_cmd(path), check=True, stage='ffprobe', items=1, capture=True)
+    output = json.loads(p.stdout.decode('utf-8'))
+    save_probe(path, stat, output)
+    return output
+
+
+def get_cached_probe(path, stat):
+    db = get_db()
+    row = db.execute(
+        'SELECT size, mtime_ns, inode, probe FROM probe_cache WHERE path = ?',
+        (str(path),)).fetchone()
+    if row and (row['size'], row['mtime_ns'], row['inode']) == (
+            stat.st_size, stat.st_mtime_ns, stat.st_ino):
+        return row['probe']
+    return None
 
 
-def get_movie_id(filename):
-    base_dir = get_folder(filename)
+def save_probe(path, stat, output):
+    if not output.get('streams'):
+        # nothing worth keeping; probe again once the file is fixed
+        return
     db = get_db()
-    cur = db.execute('SELECT id FROM movie WHERE folder = ?', (base_dir.name,))
-    return cur.fetchone()['id']
+    db.execute(
+        'INSERT OR REPLACE INTO probe_cache (path, size, mtime_ns, inode, probe) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, json.dumps(output)))
+    db.commit()
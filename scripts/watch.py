@@ -0,0 +1,285 @@
+"""Ingest movie folders as they are added to or changed in RAWDIR.
+
+Folders are watched with inotify (through ctypes) or, where that isn't
+available, by rescanning RAWDIR every few seconds. Once a folder has
+had no events for --settle seconds and its movie files have stopped
+growing, just that folder is run through the pipeline (metadata, then
+thumbnails). Any folders that changed while nothing was watching are
+caught up on at startup.
+"""
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+import traceback
+
+import constants as C
+import pipeline
+import save_metadata
+import util
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+EVENT = struct.Struct('iIII')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--poll', action='store_true', help="rescan RAWDIR instead of using inotify")
+    parser.add_argument(
+        '--interval', type=float, default=5, help="seconds between rescans when polling")
+    parser.add_argument(
+        '--settle', type=float, default=10,
+        help="seconds a folder has to be left alone before it is ingested")
+    pipeline.add_arguments(parser)
+    args = parser.parse_args()
+
+    watcher = None
+    if not args.poll:
+        try:
+            watcher = InotifyWatcher(C.RAWDIR)
+        except OSError as e:
+            print('inotify is not available ({}), polling instead'.format(e))
+    if watcher is None:
+        watcher = PollingWatcher(C.RAWDIR, args.interval)
+
+    print('catching up on {}'.format(C.RAWDIR))
+    ingest = pipeline.from_args(args)
+    pipeline.ingest_library(ingest, incremental=True)
+    report(ingest)
+    print('watching {}'.format(C.RAWDIR))
+    try:
+        watch(watcher, ingest, args.settle)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def watch(watcher, ingest, settle):
+    # folder name -> [when it last changed, its movie file sizes then]
+    pending = {}
+    while True:
+        now = time.monotonic()
+        for name in watcher.wait(timeout=min(settle, 1)):
+            pending[name] = [now, None]
+        ready = []
+        for name, entry in list(pending.items()):
+            changed, sizes = entry
+            if now - changed < settle:
+                continue
+            dirpath = C.RAWDIR.joinpath(name)
+            if not dirpath.is_dir():
+                print('{} has been removed from {}'.format(name, C.RAWDIR))
+                del pending[name]
+                continue
+            new_sizes = get_movie_sizes(dirpath)
+            if not new_sizes:
+                # nothing to ingest until a movie shows up
+                del pending[name]
+            elif new_sizes == sizes:
+                del pending[name]
+                ready.append(dirpath)
+            else:
+                # still being copied, check again in another settle period
+                entry[:] = [now, new_sizes]
+        if ready:
+            try:
+                ingest_folders(ingest, ready)
+            except Exception:
+                # e.g. the db being locked; the folders get another go
+                # when they next change, the daemon carries on
+                util.get_db().rollback()
+                traceback.print_exc()
+
+
+def ingest_folders(ingest, dirpaths):
+    states = save_metadata.get_folder_states()
+    folders = [(dirpath, not save_metadata.is_unchanged(dirpath, states.get(dirpath.name)))
+               for dirpath in dirpaths]
+    for dirpath, changed in folders:
+        print('ingesting {}{}'.format(dirpath, '' if changed else ' (metadata unchanged)'))
+    with util.timed('watch ingest', items=len(folders)):
+        asyncio.run(ingest.run(folders))
+    report(ingest)
+
+
+def report(ingest):
+    if ingest.failed:
+        ingest.report_failures()
+        del ingest.failed[:]
+    # the pipeline's timings would otherwise only be written at exit
+    util.flush_stats()
+
+
+def get_movie_sizes(dirpath):
+    sizes = {}
+    for path in save_metadata.get_all_movie_files(dirpath):
+        try:
+            sizes[str(path)] = path.stat().st_size
+        except FileNotFoundError:
+            pass
+    return sizes
+
+
+def folder_of(root, path):
+    """The movie folder name that `path` (somewhere under root) is in,
+    or None if the change is one the watcher should ignore."""
+    parts = os.path.relpath(path, str(root)).split(os.sep)
+    if parts[0] in ('.', '..') or any(p in save_metadata.SCREENS_DIRS for p in parts):
+        return None
+    if parts[0].startswith('.'):
+        return None
+    return parts[0]
+
+
+class InotifyWatcher:
+    """Report the movie folders that inotify saw changes in."""
+
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('libc has no inotify_init1')
+        self.libc = libc
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.root = root
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> directory
+        self.paths = {}
+        self.add_watch(root)
+        for dirpath, dirnames, _ in os.walk(str(root)):
+            dirnames[:] = [d for d in dirnames if d not in save_metadata.SCREENS_DIRS]
+            for d in dirnames:
+                self.add_watch(os.path.join(dirpath, d))
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, '{}: {}'.format(path, os.strerror(err)))
+        self.paths[wd] = str(path)
+
+    def wait(self, timeout):
+        """Return the folders that changed, waiting up to `timeout` seconds."""
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; treat every folder as changed
+                changed.update(p.name for p in save_metadata.get_movie_dirs())
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if wd not in self.paths:
+                continue
+            path = os.path.join(self.paths[wd], os.fsdecode(name))
+            folder = folder_of(self.root, path)
+            if folder is None:
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            changed.add(folder)
+        return changed
+
+    def add_tree(self, path):
+        # the directory may already have contents if it was moved in
+        if not self.try_add_watch(path):
+            return
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d not in save_metadata.SCREENS_DIRS]
+            for d in dirnames:
+                self.try_add_watch(os.path.join(dirpath, d))
+
+    def try_add_watch(self, path):
+        # temporary directories (rsync, unpackers) can be gone before
+        # they are watched
+        try:
+            self.add_watch(path)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Report the movie folders whose files changed between rescans."""
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.last_scan = time.monotonic()
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for dirpath in save_metadata.get_movie_dirs():
+            files = []
+            for walk_dir, dirnames, filenames in os.walk(str(dirpath)):
+                dirnames[:] = [d for d in dirnames if d not in save_metadata.SCREENS_DIRS]
+                for fn in filenames:
+                    try:
+                        stat = os.stat(os.path.join(walk_dir, fn))
+                    except FileNotFoundError:
+                        continue
+                    files.append((os.path.join(walk_dir, fn), stat.st_size, stat.st_mtime_ns))
+            snapshot[dirpath.name] = sorted(files)
+        return snapshot
+
+    def wait(self, timeout):
+        """Return the folders that changed since the last rescan, waiting
+        up to `timeout` seconds (or until the next rescan is due)."""
+        due = self.last_scan + self.interval - time.monotonic()
+        if due > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(due, 0))
+        self.last_scan = time.monotonic()
+        snapshot = self.scan()
+        changed = {name for name in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(name) != self.snapshot.get(name)}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())